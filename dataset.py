@@ -1,31 +1,335 @@
+import argparse
 from pathlib import Path
-from datasets import load_dataset
+from itertools import accumulate, islice
+from queue import Queue
+import json
+import keyword
+import math
 import random
+import re
+import threading
+
+from methods.corpus import write_shards
+from methods.jaccard import shingle, jaccard
+
+try:
+    from datasets import load_dataset
+except ImportError: # optional with synthetic=True
+    load_dataset = None
 
 # seed
 seed = 42
 random.seed(seed)
 
-def build_wiki(out_root="data", n=200):
-    ds = load_dataset("Salesforce/wikitext", "wikitext-103-v1", split="train")
-    wiki_samples = [x["text"] for x in random.sample([r for r in ds if len(r["text"].strip()) > 0], n)]
+SOURCES = {
+    "wiki": (("Salesforce/wikitext", "wikitext-103-v1"), "text"),
+    "code": (("Nan-Do/code-search-net-python",), "code"),
+}
+
+def reservoir_sample(items, n, seed=42):
+    """
+    Seeded uniform sample of n items from a stream of unknown length, in stream order
+    Algorithm L: O(n) memory, jumps over skipped items without drawing for each one
+    """
+    rng = random.Random(seed)
+    u = lambda: max(rng.random(), 1e-300) # (0, 1)
+    stream = enumerate(items)
+    reservoir = list(islice(stream, n))
+    if len(reservoir) == n and n > 0:
+        w = math.exp(math.log(u()) / n)
+        while True:
+            skip = math.floor(math.log(u()) / math.log(1 - w))
+            item = next(islice(stream, skip, None), None)
+            if item is None:
+                break
+            reservoir[rng.randrange(n)] = item
+            w *= math.exp(math.log(u()) / n)
+    reservoir.sort(key=lambda x: x[0])
+    return [x for _, x in reservoir]
+
+def stream_rows(name, split="train"):
+    """Non-empty texts of a source, streamed (no full download/materialization)"""
+    args, field = SOURCES[name]
+    ds = load_dataset(*args, split=split, streaming=True)
+    return (row[field] for row in ds if len(row[field].strip()) > 0)
+
+# ------------------------------------------------------------ #
+# Synthetic corpus (offline)
+# ------------------------------------------------------------ #
+
+def _vocab(rng, size):
+    syllables = [c + v for c in "bcdfghjklmnprstvwz" for v in "aeiou"] + list("aeiou")
+    return list({"".join(rng.choices(syllables, k=rng.randint(1, 4))) for _ in range(size)})
+
+def _mutate(rng, parts, rate):
+    """Near-duplicate: drop, replace or duplicate a fraction of the parts"""
+    out = []
+    for part in parts:
+        x = rng.random()
+        if x < rate / 3:
+            continue
+        out.append(rng.choice(parts) if x < 2 * rate / 3 else part)
+        if x > 1 - rate / 3:
+            out.append(part)
+    return out or parts
+
+class SyntheticCorpus:
+    """
+    Seeded generator of synthetic docs as lists of parts (words for wiki, lines for code)
+     - wiki: sentences of Zipf-distributed pseudo-words
+     - code: Python functions built from random statements/expressions
+    """
+    def __init__(self, name="wiki", seed=42):
+        self.name = name
+        self.rng = random.Random(seed)
+        self.vocab = _vocab(self.rng, 50000)
+        self.cum_weights = list(accumulate(1 / (rank + 1) for rank in range(len(self.vocab))))
+        self.idents = self.vocab[:5000]
+
+    def join(self, parts):
+        return ("\n" if self.name == "code" else " ").join(parts)
+
+    def word(self):
+        return self.rng.choices(self.vocab, cum_weights=self.cum_weights)[0]
+
+    def sentence(self):
+        words = self.rng.choices(self.vocab, cum_weights=self.cum_weights, k=self.rng.randint(6, 25))
+        return " ".join(words).capitalize() + "."
+
+    def expr(self, depth=0):
+        # code tokenizer abstracts names/literals, so vary the shape
+        rng, idents = self.rng, self.idents
+        x = rng.random()
+        if depth > 2 or x < 0.35:
+            return rng.choice([rng.choice(idents), str(rng.randint(0, 999)), f"'{rng.choice(idents)}'", "None", "True"])
+        if x < 0.55:
+            return f"{self.expr(depth + 1)} {rng.choice(['+', '-', '*', '/', '%', '==', '<', 'and', 'or'])} {self.expr(depth + 1)}"
+        if x < 0.75:
+            args = ", ".join(self.expr(depth + 1) for _ in range(rng.randint(0, 3)))
+            return f"{'.'.join(rng.sample(idents, rng.randint(1, 3)))}({args})"
+        if x < 0.85:
+            return f"{rng.choice(idents)}[{self.expr(depth + 1)}]"
+        if x < 0.95:
+            return "[" + ", ".join(self.expr(depth + 1) for _ in range(rng.randint(0, 4))) + "]"
+        return "{" + ", ".join(f"'{rng.choice(idents)}': {self.expr(depth + 1)}" for _ in range(rng.randint(1, 3))) + "}"
+
+    def statement(self, depth=0):
+        rng = self.rng
+        a, b = rng.sample(self.idents, 2)
+        if depth < 2 and rng.random() < 0.25:
+            head = rng.choice([f"if {self.expr()}:", f"for {a} in {self.expr()}:", f"while {self.expr()}:",
+                               "try:", f"with {self.expr()} as {a}:"])
+            return [head] + ["    " + line for _ in range(rng.randint(1, 4)) for line in self.statement(depth + 1)]
+        return [rng.choice([
+            f"{a} = {self.expr()}",
+            f"{a} += {self.expr()}",
+            f"{a}.{b}({self.expr()})",
+            f"return {self.expr()}",
+            f"yield {self.expr()}",
+            f"raise ValueError({self.expr()})",
+            f"assert {self.expr()}",
+            f"{a}, {b} = {self.expr()}, {self.expr()}",
+        ])]
+
+    def part(self):
+        """One fresh part: a word, or a statement line"""
+        return "    " + self.statement(2)[0] if self.name == "code" else self.word()
+
+    def doc(self):
+        rng = self.rng
+        if self.name == "code":
+            args = ", ".join(rng.sample(self.idents, rng.randint(0, 3)))
+            body = [line for _ in range(rng.randint(3, 20)) for line in self.statement()]
+            return [f"def {rng.choice(self.idents)}({args}):"] + ["    " + line for line in body]
+        return " ".join(self.sentence() for _ in range(rng.randint(3, 40))).split(" ")
+
+def synthetic_texts(name="wiki", seed=42, dup_rate=0.1, mutate=0.1):
+    """
+    Endless stream of synthetic docs for offline runs (see SyntheticCorpus)
+     - dup_rate of docs are near-duplicates (mutate = fraction of words/lines edited) of an earlier doc
+    """
+    synth = SyntheticCorpus(name, seed)
+    rng = synth.rng
+    recent = [] # pool of docs to copy from, as word/line lists
+    while True:
+        if recent and rng.random() < dup_rate:
+            parts = _mutate(rng, rng.choice(recent), mutate)
+        else:
+            parts = synth.doc()
+        recent = (recent + [parts])[-1000:]
+        yield synth.join(parts)
 
-    file_path = Path(out_root) / "wiki"
-    write_txts(wiki_samples, file_path, "wiki")
+# ------------------------------------------------------------ #
+# Planted near-duplicate clusters (benchmarks)
+# ------------------------------------------------------------ #
 
-def build_code(out_root="data", n=200):
-    ds = load_dataset("Nan-Do/code-search-net-python", split="train")
-    code_samples = [x["code"] for x in random.sample([r for r in ds if len(r["code"].strip()) > 0], n)]
+PERTURBATIONS = ("edit", "insert", "reorder", "rename")
 
-    file_path = Path(out_root) / "code"
-    write_txts(code_samples, file_path, "code")
+def perturb(rng, parts, kind, rate, fresh):
+    """
+    Copy of a word/line list with one perturbation touching ~rate of it
+     - edit: replace parts with fresh ones
+     - insert: insert fresh parts
+     - reorder: cut into blocks and shuffle them
+     - rename: consistently rename a fraction of the distinct identifiers/words
+    """
+    parts = list(parts)
+    m = max(1, round(rate * len(parts)))
+    if kind == "edit":
+        for i in rng.sample(range(len(parts)), min(m, len(parts))):
+            parts[i] = fresh()
+    elif kind == "insert":
+        for _ in range(m):
+            parts.insert(rng.randrange(len(parts) + 1), fresh())
+    elif kind == "reorder":
+        cuts = sorted(rng.sample(range(1, len(parts)), min(m, len(parts) - 1))) if len(parts) > 1 else []
+        blocks = [parts[a:b] for a, b in zip([0] + cuts, cuts + [len(parts)])]
+        rng.shuffle(blocks)
+        parts = [x for block in blocks for x in block]
+    elif kind == "rename":
+        names = sorted({w for p in parts for w in re.findall(r"[^\W\d]\w*", p) if not keyword.iskeyword(w)})
+        renamed = {w: f"v{rng.getrandbits(32):x}" for w in rng.sample(names, round(rate * len(names)))}
+        if renamed:
+            parts = ["".join(renamed.get(tok, tok) for tok in re.split(r"(\W+)", p)) for p in parts]
+    return parts
+
+def plant_variant(synth, parts, base, level, kind, n, type, steps=6):
+    """
+    Perturbation of parts whose Jaccard to the base shingle set is as low as possible
+    while >= level (binary search on the rate), returns (parts, jaccard)
+    """
+    best = (parts, 1.0)
+    lo, hi = 0.0, 1.0
+    for _ in range(steps):
+        rate = (lo + hi) / 2
+        variant = perturb(synth.rng, parts, kind, rate, synth.part)
+        j = jaccard(base, shingle(synth.join(variant), n, type))
+        if j >= level:
+            best, lo = (variant, j), rate
+        else:
+            hi = rate
+    return best
+
+def build_planted(name, outdir, docs=1000, dup_frac=0.3, sizes=(2, 5), levels=(0.9, 0.7, 0.5),
+                  n=4, type="text", seed=42, shard_size=10000):
+    """
+    Synthetic corpus with planted near-duplicate clusters, written as JSONL shards + truth.json
+     - dup_frac of docs are in clusters of sizes[0]..sizes[1] members: a base doc
+       and variants perturbed (edit/insert/reorder/rename) down to a Jaccard level
+       (shingles n/type, measured against the base)
+     - truth.json: cluster of each clustered doc id (ids are name_000000.txt .. in creation
+       order), and base/kind/level/jaccard of each variant
+    """
+    synth = SyntheticCorpus(name, seed)
+    rng = synth.rng
+    records, clusters, variants = [], {}, []
+    cluster_id = 0
+    while len(records) < docs:
+        parts = synth.doc()
+        base_id = f"{name}_{len(records):06d}.txt"
+        records.append((base_id, synth.join(parts)))
+        size = rng.randint(*sizes) if rng.random() < dup_frac / ((sizes[0] + sizes[1]) / 2) else 1
+        if size == 1:
+            continue
+        clusters[base_id] = cluster_id
+        base = shingle(records[-1][1], n, type)
+        for _ in range(min(size - 1, docs - len(records))):
+            level, kind = rng.choice(levels), rng.choice(PERTURBATIONS)
+            variant, j = plant_variant(synth, parts, base, level, kind, n, type)
+            doc_id = f"{name}_{len(records):06d}.txt"
+            records.append((doc_id, synth.join(variant)))
+            clusters[doc_id] = cluster_id
+            variants.append({"id": doc_id, "base": base_id, "kind": kind, "level": level, "jaccard": j})
+        cluster_id += 1
+
+    rng.shuffle(records) # spread clusters over shards
+    outdir = Path(outdir)
+    write_shards(({"id": doc_id, "text": text, "length": len(text)} for doc_id, text in records), outdir, name, shard_size)
+    truth = {"name": name, "docs": len(records), "n": n, "type": type, "seed": seed, "clusters": clusters, "variants": variants}
+    (outdir / "truth.json").write_text(json.dumps(truth))
+    return truth
+
+# ------------------------------------------------------------ #
+# Output
+# ------------------------------------------------------------ #
+
+class ShardWriter:
+    """
+    Background writer: put() records {"id", "text", "length"}, a thread writes them
+    as one .txt per record (fmt = "txt") or as jsonl/parquet shards of shard_size
+    """
+    def __init__(self, outdir, prefix, fmt="txt", shard_size=10000, maxsize=10000):
+        self.outdir = Path(outdir)
+        self.outdir.mkdir(parents=True, exist_ok=True)
+        self.prefix, self.fmt, self.shard_size = prefix, fmt, shard_size
+        self.queue = Queue(maxsize) # bounded, producer waits on a slow disk
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        records = iter(self.queue.get, None)
+        try:
+            if self.fmt == "txt":
+                for rec in records:
+                    (self.outdir / rec["id"]).write_text(rec["text"])
+            else:
+                write_shards(records, self.outdir, self.prefix, self.shard_size, self.fmt)
+        except Exception as e:
+            self.error = e
+            for _ in records: # drain so put() never blocks
+                pass
+
+    def put(self, rec):
+        self.queue.put(rec)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def build(name, out_root="data", n=200, fmt="txt", shard_size=10000, synthetic=False):
+    """
+    Sample n non-empty docs of a source into out_root/name
+     - streams the HF dataset with reservoir sampling (needs datasets, load errors are raised),
+       or the synthetic corpus if synthetic=True (offline runs, opt-in only)
+     - fmt = "txt" (one file per doc) or "jsonl"/"parquet" shards (see corpus.list_docs)
+    """
+    if synthetic:
+        texts = islice(synthetic_texts(name, seed), n)
+    elif load_dataset is None:
+        raise ImportError("datasets is not installed (pip install -r requirements.txt), or pass synthetic=True")
+    else:
+        texts = reservoir_sample(stream_rows(name), n, seed)
+
+    with ShardWriter(Path(out_root) / name, name, fmt, shard_size) as writer:
+        for i, text in enumerate(texts):
+            writer.put({"id": f"{name}_{i:05d}.txt", "text": text, "length": len(text)})
+
+def build_wiki(out_root="data", n=200, fmt="txt", shard_size=10000, synthetic=False):
+    build("wiki", out_root, n, fmt, shard_size, synthetic)
+
+def build_code(out_root="data", n=200, fmt="txt", shard_size=10000, synthetic=False):
+    build("code", out_root, n, fmt, shard_size, synthetic)
 
 def write_txts(items, outdir, prefix):
     outdir = Path(outdir)
     outdir.mkdir(parents=True, exist_ok=True)
     for i, item in enumerate(items):
         (outdir / f"{prefix}_{i:05d}.txt").write_text(item)
-    
+
 if __name__ == "__main__":
-    build_wiki(out_root="data/init", n=100000)
-    build_code(out_root="data/init", n=100000)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Sample the wiki / code corpora into data/init")
+    parser.add_argument("--n", type=int, default=100000)
+    parser.add_argument("--fmt", default="txt", choices=["txt", "jsonl", "parquet"])
+    parser.add_argument("--synthetic", action="store_true", help="generate the offline synthetic corpus instead")
+    args = parser.parse_args()
+    build_wiki(out_root="data/init", n=args.n, fmt=args.fmt, synthetic=args.synthetic)
+    build_code(out_root="data/init", n=args.n, fmt=args.fmt, synthetic=args.synthetic)
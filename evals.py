@@ -1,8 +1,16 @@
 from pathlib import Path
-import time, shutil
-from methods.jaccard import dedup_jaccard
-from methods.lsh import dedup_lsh
-from methods.simhash import dedup_sim
+from collections import Counter
+from itertools import product
+import argparse, contextlib, io, json, platform, resource, subprocess
+import multiprocessing as mp
+import time, shutil, tempfile
+import numpy as np
+from dataset import build_planted
+from methods.jaccard import dedup_jaccard, normalize_code, tokenize_code, lex_code, shingle
+from methods.lsh import dedup_lsh, MinHash, OnePermutationHash, hash_shingles, hashed_jaccard
+from methods.simhash import dedup_sim, SimHashIndex, popcount64
+from methods.batch import dedup_lsh_batch
+from methods.corpus import list_docs
 
 def kept_set(dirpath):
     return {p.name for p in Path(dirpath).glob("*.txt")}
@@ -38,44 +46,277 @@ def run_and_time(fn, **kwargs):
     fn(**kwargs)
     return time.perf_counter() - t0
 
+def docs_by_name(indir, length=None):
+    """Docs of a corpus (.txt dir or JSONL/Parquet shards, see corpus.list_docs) in name order"""
+    docs = sorted(list_docs(indir), key=lambda doc: doc.name)
+    return docs[:length] if length else docs
+
+def bench_lexer(indir, length=None):
+    """Regex lexer vs tokenize: token stream agreement and throughput on a code corpus"""
+    files = docs_by_name(indir, length)
+    codes = [normalize_code(p.read_text()) for p in files]
+
+    ref = []
+    t0 = time.perf_counter()
+    for code in codes:
+        try:
+            ref.append(tokenize_code(code))
+        except SyntaxError: # IndentationError escapes tokenize_code
+            ref.append([])
+    t_tok = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    out = [lex_code(code) for code in codes]
+    t_re = time.perf_counter() - t0
+
+    failed = sum(1 for a in ref if not a) # tokenize dropped these docs
+    same = sum(1 for a, b in zip(ref, out) if a and a == b)
+    mb = sum(len(code) for code in codes) / 1e6
+    print(f"lexer: same={same}/{len(codes) - failed} | tokenize_failed={failed} | "
+          f"tokenize={mb / t_tok:.2f}MB/s | regex={mb / t_re:.2f}MB/s | speed-up={t_tok / t_re:.1f}x")
+    return {"same": same, "total": len(codes), "tokenize_failed": failed, "tokenize_s": t_tok, "regex_s": t_re}
+
+def bench_signers(indir, n=4, type="text", tau=0.30, k=336, r=3, length=None, pairs=5000, seed=0):
+    """
+    OPH vs MinHash at one config: signing throughput, estimate error against exact
+    (fingerprint) Jaccard on random doc pairs, and kept-set agreement of dedup_lsh
+    """
+    files = docs_by_name(indir, length)
+    docs = [np.unique(hash_shingles(shingle(p.read_text(), n, type))) for p in files]
+
+    sigs, secs = {}, {}
+    for name, signer in (("minhash", MinHash(k=k)), ("oph", OnePermutationHash(k=k))):
+        t0 = time.perf_counter()
+        sigs[name] = np.stack([signer.signature_from_hashes(xs) for xs in docs])
+        secs[name] = time.perf_counter() - t0
+
+    rng = np.random.default_rng(seed)
+    i, j = rng.integers(0, len(docs), size=(2, pairs))
+    i, j = i[i != j], j[i != j]
+    exact = np.array([hashed_jaccard(docs[a], docs[b]) for a, b in zip(i.tolist(), j.tolist())])
+    err = {name: float(np.abs((s[i] == s[j]).mean(axis=1) - exact).mean()) for name, s in sigs.items()}
+
+    kept = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in sigs:
+            dedup_lsh(indir=indir, outdir=f"{tmp}/{name}", n=n, type=type, tau=tau, k=k, r=r, length=length, signer=name)
+            kept[name] = kept_set(f"{tmp}/{name}")
+    agree = len(kept["minhash"] & kept["oph"])
+
+    print(f"signers ({type}, k={k}): minhash={secs['minhash']:.2f}s | oph={secs['oph']:.2f}s | "
+          f"speed-up={secs['minhash'] / secs['oph']:.1f}x")
+    print(f"estimate MAE: minhash={err['minhash']:.4f} | oph={err['oph']:.4f} over {len(exact)} pairs")
+    print(f"kept: minhash={len(kept['minhash'])} | oph={len(kept['oph'])} | agree={agree}")
+    return {"seconds": secs, "mae": err, "kept": {name: len(x) for name, x in kept.items()}, "agree": agree}
+
+def bench_simhash(n, t, queries=2000, seed=0):
+    """
+    SimHashIndex vs brute-force popcount over every kept code: random 64-bit codes, a third of
+    them near copies (<= t + 2 flipped bits) of earlier ones, queried then added in order (as in
+    dedup_sim); only the last `queries` probes are timed
+    """
+    rng = np.random.default_rng(seed)
+    codes = rng.integers(0, 1 << 63, size=n, dtype=np.uint64) << np.uint64(1) | rng.integers(0, 2, size=n, dtype=np.uint64)
+    for i in rng.choice(np.arange(1, n), n // 3, replace=False).tolist():
+        flips = rng.choice(64, rng.integers(0, t + 3), replace=False)
+        codes[i] = codes[rng.integers(0, i)] ^ np.bitwise_or.reduce(np.uint64(1) << flips.astype(np.uint64))
+
+    index, timed = SimHashIndex(t=t), n - queries
+    t0 = time.perf_counter()
+    for i, code in enumerate(codes[:timed].tolist()):
+        index.add(i, code)
+    build = time.perf_counter() - t0
+
+    got, t_index = [], 0.0
+    for i, code in enumerate(codes[timed:].tolist(), timed):
+        t0 = time.perf_counter()
+        got.append(index.candidates(code))
+        t_index += time.perf_counter() - t0
+        index.add(i, code)
+
+    same, t_brute = 0, 0.0
+    for i, (code, found) in enumerate(zip(codes[timed:], got), timed):
+        t0 = time.perf_counter()
+        near = set(np.flatnonzero(popcount64(codes[:i] ^ code) <= t).tolist())
+        t_brute += time.perf_counter() - t0
+        same += near == found
+
+    print(f"simhash (n={n}, t={t}): tables={index.tables or 'brute'} | index={t_index / queries * 1e6:.0f}us/query | "
+          f"brute={t_brute / queries * 1e6:.0f}us/query | speed-up={t_brute / t_index:.1f}x | "
+          f"same={same}/{queries} | build={build:.1f}s | {index.nbytes / n:.0f}B/code")
+    return {"index_s": t_index, "brute_s": t_brute, "same": same, "queries": queries, "tables": index.tables,
+            "build_s": build, "nbytes": index.nbytes}
+
 def clean(path):
     p = Path(path)
     if p.exists():
         shutil.rmtree(p)
     p.mkdir(parents=True)
-    
+
+# ------------------------------------------------------------ #
+# Benchmark suite: planted corpora x methods x scales x params
+# ------------------------------------------------------------ #
+
+CONFIGS = { # README configs, lists are the default grid
+    "text": dict(name="wiki", n=4, tau=[0.30], k=[336], r=[3], t=[7]),
+    "code": dict(name="code", n=5, tau=[0.45], k=[192], r=[3], t=[7]),
+}
+METHODS = {"jaccard": dedup_jaccard, "lsh": dedup_lsh, "sim": dedup_sim, "batch": dedup_lsh_batch}
+GRID_KEYS = {"jaccard": ("tau",), "lsh": ("tau", "k", "r"), "sim": ("tau", "k", "r", "t"), "batch": ("tau", "k", "r")}
+
+def planted(type, docs, root="data/bench", seed=42):
+    """Planted corpus (JSONL shards + truth.json) for type/docs, generated once and reused"""
+    cfg = CONFIGS[type]
+    outdir = Path(root) / f"{type}-{docs}-{seed}"
+    if (outdir / "truth.json").exists():
+        return outdir, json.loads((outdir / "truth.json").read_text())
+    shutil.rmtree(outdir, ignore_errors=True)
+    return outdir, build_planted(cfg["name"], outdir, docs=docs, n=cfg["n"], type=type, seed=seed)
+
+def score(kept, truth, tau):
+    """
+    Precision / recall of removed docs against the planted clusters
+     - precision: removed docs that are in a planted cluster
+     - recall: per cluster, removals up to its number of variants with Jaccard(base) >= tau,
+       over all such variants
+    """
+    clusters = truth["clusters"]
+    ids = {f"{truth['name']}_{i:06d}.txt" for i in range(truth["docs"])}
+    removed = ids - set(kept)
+    hits = Counter(clusters[x] for x in removed if x in clusters)
+    expected = Counter(clusters[v["id"]] for v in truth["variants"] if v["jaccard"] >= tau)
+    found = sum(min(hits[c], e) for c, e in expected.items())
+    return {
+        "precision": sum(hits.values()) / len(removed) if removed else 1.0,
+        "recall": found / sum(expected.values()) if expected else 1.0,
+    }
+
+def _measure(conn, method, kwargs):
+    try:
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats = METHODS[method](**kwargs)
+        secs = time.perf_counter() - t0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # KB on linux
+        conn.send((stats, secs, peak, None))
+    except Exception as e:
+        conn.send((None, None, None, repr(e)))
+
+def measure(method, **kwargs):
+    """Run one dedup in a fresh spawned process, returns (stats, seconds, peak RSS MB)"""
+    ctx = mp.get_context("spawn")
+    parent, child = ctx.Pipe()
+    proc = ctx.Process(target=_measure, args=(child, method, kwargs))
+    proc.start()
+    stats, secs, peak, error = parent.recv()
+    proc.join()
+    if error:
+        raise RuntimeError(f"{method} {kwargs}: {error}")
+    return stats, secs, peak
+
+def grid(method, cfg, overrides):
+    """Param dicts of a method: product of the config lists, overridden from the CLI"""
+    keys = GRID_KEYS[method]
+    values = [overrides.get(key) or cfg[key] for key in keys]
+    for combo in product(*values):
+        params = dict(zip(keys, combo))
+        if "r" in params and params["k"] % params["r"]:
+            continue
+        if method == "jaccard":
+            params["engine"] = "prefix"
+        yield params
+
+def meta():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit, "python": platform.python_version(),
+            "numpy": np.__version__, "machine": platform.machine(), "cpus": mp.cpu_count()}
+
+def run_suite(types=("text", "code"), scales=(1000, 10000), methods=("jaccard", "lsh", "sim"), overrides=None,
+              root="data/bench", out="results/bench.json", seed=42, workers=1, jaccard_max=10000):
+    """
+    Every method x type x scale x param combo on planted corpora, one fresh process per run
+    Writes {"meta", "results"} to out, one result row per run
+    """
+    results = []
+    for type in types:
+        cfg = CONFIGS[type]
+        for docs in scales:
+            indir, truth = planted(type, docs, root, seed)
+            for method in methods:
+                if method == "jaccard" and docs > jaccard_max: # exact baseline is quadratic
+                    continue
+                for params in grid(method, cfg, overrides or {}):
+                    extra = {} if method == "jaccard" else {"workers": workers}
+                    with tempfile.TemporaryDirectory() as tmp:
+                        stats, secs, peak = measure(method, indir=str(indir), outdir=tmp, n=cfg["n"], type=type,
+                                                    output="manifest", **params, **extra)
+                        kept = json.loads((Path(tmp) / "kept.json").read_text())
+                    row = {
+                        "method": method, "type": type, "docs": docs, "params": params,
+                        "seconds": secs, "docs_per_sec": docs / secs, "peak_rss_mb": peak,
+                        "kept": len(kept), "candidates": stats.get("candidates"),
+                        "pairs_checked": stats.get("pairs_checked"), **score(kept, truth, params["tau"]),
+                    }
+                    results.append(row)
+                    print(f"{method:8s} {type} {docs:>7d} {params} | {row['docs_per_sec']:9.1f} docs/s | "
+                          f"{peak:7.1f} MB | kept={row['kept']} | P={row['precision']:.3f} R={row['recall']:.3f}")
+
+    out = Path(out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps({"meta": meta(), "results": results}, indent=1))
+    return results
+
+def run_signers(types, scales, indir=None, root="data/bench", seed=42, length=None, overrides=None):
+    """bench_signers on indir, or on each planted corpus of types x scales (README config)"""
+    for type in types:
+        cfg = {key: (overrides or {}).get(key) or value for key, value in CONFIGS[type].items()}
+        for path in [indir] if indir else [planted(type, docs, root, seed)[0] for docs in scales]:
+            print(f"== {path}")
+            bench_signers(path, n=cfg["n"], type=type, tau=cfg["tau"][0], k=cfg["k"][0], r=cfg["r"][0], length=length)
+
+def run_lexer(scales, indir=None, root="data/bench", seed=42, length=None):
+    """bench_lexer on indir, or on each planted code corpus of scales"""
+    for path in [indir] if indir else [planted("code", docs, root, seed)[0] for docs in scales]:
+        print(f"== {path}")
+        bench_lexer(path, length)
+
+def run_simhash(scales, ts):
+    """bench_simhash for each scale x t"""
+    for n in scales:
+        for t in ts:
+            bench_simhash(n, t)
+
 if __name__ == "__main__":
-    # Text
-    #clean("data/jaccard/wiki")
-    #clean("data/lsh/wiki")
-    clean("data/hier/wiki")
-
-    #tj_text = run_and_time(dedup_jaccard, indir="data/exact/wiki", outdir="data/jaccard/wiki", n=4, type="text", tau=0.30)
-    #tl_text = run_and_time(dedup_lsh, indir="data/exact/wiki", outdir="data/lsh/wiki", n=4, type="text", tau=0.30, k=336, r=3)
-    th_text = run_and_time(dedup_sim, indir="data/exact/wiki", outdir="data/hier/wiki", n=4, type="text", tau=0.30, t=7, k=336, r=3)
-    
-    # Code
-    #clean("data/jaccard/code"); 
-    #clean("data/lsh/code")
-    clean("data/hier/code")
-    
-    #tj_code = run_and_time(dedup_jaccard, indir="data/exact/code", outdir="data/jaccard/code", n=5, type="code", tau=0.45)
-    #tl_code = run_and_time(dedup_lsh, indir="data/exact/code", outdir="data/lsh/code", n=5, type="code", tau=0.45, k=192, r=3)
-    th_code = run_and_time(dedup_sim, indir="data/exact/code", outdir="data/hier/code", n=5, type="code", tau=0.45, t=7, k=192, r=3)
-    
-    
-    # Compare
-    #print(f"text: jaccard={tj_text:.2f}s | lsh={tl_text:.2f}s")
-    #print(f"code: jaccard={tj_code:.2f}s | lsh={tl_code:.2f}s")
-    
-    # print(f"text: lsh={tl_text:.2f}s")
-    # print(f"code: lsh={tl_code:.2f}s")
-    print(f"text: hier={th_text:.2f}s")
-    print(f"code: hier={th_code:.2f}s")
-
-    #compare("data/jaccard/wiki", "data/lsh/wiki", "text")
-    #compare("data/jaccard/code", "data/lsh/code", "code")
-    # compare("data/exact/wiki", "data/lsh/wiki", "data/hier/wiki", "text")
-    # compare("data/exact/code", "data/lsh/code", "data/hier/code", "code")
-    compare_lsh_hier("data/lsh/wiki", "data/hier/wiki", "text")
-    compare_lsh_hier("data/lsh/code", "data/hier/code", "code")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Dedup benchmarks on synthetic corpora with planted near-duplicates")
+    parser.add_argument("command", nargs="?", default="suite", choices=["suite", "signers", "lexer", "simhash"],
+                        help="suite = methods x scales grid, signers = OPH vs MinHash, lexer = regex vs tokenize, "
+                             "simhash = SimHashIndex vs brute-force popcount (random codes, --scales x --t)")
+    parser.add_argument("--indir", help="signers / lexer: corpus to use instead of the planted ones")
+    parser.add_argument("--length", type=int, help="signers / lexer: first docs by name")
+    parser.add_argument("--types", nargs="+", default=["text", "code"], choices=list(CONFIGS))
+    parser.add_argument("--scales", nargs="+", type=int, default=[1000, 10000], help="corpus sizes, e.g. 1000 10000 100000")
+    parser.add_argument("--methods", nargs="+", default=["jaccard", "lsh", "sim"], choices=list(METHODS))
+    parser.add_argument("--tau", nargs="+", type=float, help="grid override")
+    parser.add_argument("--k", nargs="+", type=int, help="grid override")
+    parser.add_argument("--r", nargs="+", type=int, help="grid override")
+    parser.add_argument("--t", nargs="+", type=int, help="grid override")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--jaccard-max", type=int, default=10000, help="skip exact jaccard above this size")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--root", default="data/bench", help="planted corpora cache")
+    parser.add_argument("--out", default="results/bench.json")
+    args = parser.parse_args()
+
+    overrides = {key: getattr(args, key) for key in ("tau", "k", "r", "t") if getattr(args, key)}
+    if args.command == "signers":
+        run_signers(args.types, args.scales, args.indir, args.root, args.seed, args.length, overrides)
+    elif args.command == "lexer":
+        run_lexer(args.scales, args.indir, args.root, args.seed, args.length)
+    elif args.command == "simhash":
+        run_simhash(args.scales, args.t or [3, 7, 16])
+    else:
+        run_suite(args.types, args.scales, args.methods, overrides, args.root, args.out, args.seed,
+                  args.workers, args.jaccard_max)
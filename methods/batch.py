@@ -0,0 +1,116 @@
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from methods.lsh import MinHash, band_keys_array, candidate_pairs
+from methods.store import hashed_jaccard, ShingleArena
+from methods.pipeline import sign_files
+from methods.shard import ShardedLSH
+from methods.cache import DocCache
+from methods.corpus import list_docs, write_kept
+
+# ------------------------------------------------------------ #
+# Offline LSH: sign all -> group band keys -> verify pairs -> union-find
+# ------------------------------------------------------------ #
+
+class UnionFind:
+    """Disjoint sets over 0..n-1, the smaller index becomes the root"""
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]] # path halving
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            if b < a:
+                a, b = b, a
+            self.parent[b] = a
+
+_worker = {}
+
+def _init(arena, offsets, tau):
+    _worker.update(shingles=ShingleArena(arena, offsets), tau=tau)
+
+def _verify(pairs):
+    shingles, tau = _worker["shingles"], _worker["tau"]
+    return np.array([hashed_jaccard(shingles[i], shingles[j]) >= tau for i, j in pairs.tolist()], dtype=bool)
+
+def verify_pairs(pairs, shingles, tau, workers=1, chunksize=4096):
+    """Exact (fingerprint) Jaccard >= tau for each candidate pair, chunks across a process pool"""
+    if workers <= 1 or len(pairs) <= chunksize:
+        return np.array([hashed_jaccard(shingles[i], shingles[j]) >= tau for i, j in pairs.tolist()], dtype=bool)
+    chunks = [pairs[i:i + chunksize] for i in range(0, len(pairs), chunksize)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=(*shingles.flat(), tau)) as ex:
+        return np.concatenate(list(ex.map(_verify, chunks)))
+
+def dedup_lsh_batch(indir, outdir, n=10, type="text", tau=0.5, k=128, r=4, seed=42, length=None, workers=1,
+                    chunksize=64, hashing="blake2b", lexer="tokenize", keep="largest", shards=0,
+                    cache=None, cache_bytes=1 << 30, output="txt"):
+    """
+    Offline MinHash-LSH dedup for large batches
+     - Sign every file first (workers > 1 = process pool), no query/insert order
+     - Group (band, band_key, doc) records per band to enumerate candidate pairs in bulk
+       (shards > 1 = map-reduce over band ranges in shard processes)
+     - Verify pairs on shingle fingerprints in parallel, merge duplicates with union-find
+     - Keep one representative per cluster: keep = "largest" file or "first" by name
+     - cache = dir of a content-addressed DocCache (see cache.py), bounded to cache_bytes
+     - indir = dir of .txt files or of JSONL/Parquet shards (see corpus.list_docs)
+     - output = "txt" files, "manifest" of kept ids, "jsonl" or "parquet" shards (see corpus.write_kept)
+    Clusters are transitive, so this can drop more than the greedy dedup_lsh
+    """
+    indir, outdir = Path(indir), Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    minhash = MinHash(k=k, seed=seed)
+
+    files = list_docs(indir, length) # largest first
+    if keep == "first":
+        files = sorted(files, key=lambda x: x.name)
+
+    doc_cache = DocCache(cache, max_bytes=cache_bytes) if cache is not None else None
+    shingles = ShingleArena()
+    signatures = np.zeros((len(files), k), dtype=np.uint64)
+    signed = sign_files(files, n, type, (minhash,), workers=workers, chunksize=chunksize, compact=True,
+                        hashing=hashing, lexer=lexer, cache=doc_cache)
+    for doc_id, (sh, (sig,)) in enumerate(signed):
+        shingles.append(sh)
+        signatures[doc_id] = sig
+    if doc_cache is not None:
+        doc_cache.evict()
+    band_keys = band_keys_array(signatures, r) # keys only group docs here, all bands in one pass
+
+    if shards > 1:
+        with ShardedLSH.local(k=k, r=r, shards=shards) as sharded:
+            pairs = sharded.pairs(band_keys)
+    else:
+        pairs = candidate_pairs(band_keys)
+    dup = verify_pairs(pairs, shingles, tau, workers=workers)
+
+    clusters = UnionFind(len(files))
+    for i, j in pairs[dup].tolist():
+        clusters.union(i, j)
+    kept_paths = [path for doc_id, path in enumerate(files) if clusters.find(doc_id) == doc_id] # roots = min index
+
+    print(f"{len(kept_paths)} unique files out of {len(files)} total files")
+    print(f"Candidate pairs: {len(pairs)}, Duplicate pairs: {int(dup.sum())}")
+
+    write_kept(kept_paths, outdir, output)
+
+    return {
+        "unique_count": len(kept_paths),
+        "total_files": len(files),
+        "candidates": len(pairs),
+        "pairs_checked": len(pairs),
+        "duplicate_pairs": int(dup.sum()),
+    }
+
+if __name__ == "__main__":
+    dedup_lsh_batch(indir="data/exact/wiki", outdir="data/lsh_batch/wiki", n=4, type="text", tau=0.30, k=336, r=3, length=1000)
+    dedup_lsh_batch(indir="data/exact/code", outdir="data/lsh_batch/code", n=5, type="code", tau=0.45, k=192, r=3, length=1000)
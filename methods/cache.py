@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from methods.exact import md5
+from methods.jaccard import shingle
+from methods.hashing import fingerprint, shingle_hashes
+
+CACHE_VERSION = 1 # bump when shingling/hashing/signing output changes
+
+def signer_key(signer):
+    """Params that determine a signer's output"""
+    return dict(signer=type(signer).__name__, k=getattr(signer, "k", None),
+                bits=getattr(signer, "bits", None), seed=getattr(signer, "seed", None))
+
+class DocCache:
+    """
+    On-disk cache of per-document preprocessing, content addressed
+     - key = md5(file content) + params, so renamed/copied files hit and edited files miss
+     - shingles: fingerprint (sorted unique uint64 hashes), keyed by n/type/hashing/lexer
+     - signatures: one entry per signer (MinHash/OPH signature, SimHash code),
+       keyed by the shingle key + signer params, shared across methods
+     - size bounded LRU: hits touch the file mtime, evict() drops the oldest entries
+     - a different CACHE_VERSION on disk wipes the cache
+    Entries are single .npy files written atomically, safe to share across worker processes
+    """
+    def __init__(self, root, max_bytes=1 << 30):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        version = self.root / "VERSION"
+        if not version.exists() or version.read_text().strip() != str(CACHE_VERSION):
+            for child in self.root.iterdir():
+                if child.is_dir():
+                    shutil.rmtree(child)
+            version.write_text(str(CACHE_VERSION))
+
+    def key(self, *parts, **params):
+        return hashlib.md5(json.dumps([CACHE_VERSION, *parts, params], sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        return self.root / key[:2] / f"{key}.npy"
+
+    def load(self, key):
+        path = self._path(key)
+        try:
+            arr = np.load(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        os.utime(path) # LRU
+        return arr
+
+    def save(self, key, arr):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, arr)
+        os.replace(tmp, path)
+
+    def shingles(self, path, n=10, type="text", hashing="blake2b", lexer="tokenize", digest=None):
+        """Fingerprint of a file (Path or corpus.Doc), returns (shingle key, fingerprint)"""
+        base = self.key(digest or md5(path), n=n, type=type, hashing=hashing, lexer=lexer)
+        xs = self.load(base)
+        if xs is None:
+            text = path.read_text()
+            if hashing == "rolling":
+                xs = shingle_hashes(text, n, type, lexer)
+            else:
+                xs = fingerprint(shingle(text, n, type, lexer))
+            self.save(base, xs)
+        return base, xs
+
+    def signature(self, base, signer, xs):
+        """Signature of a cached fingerprint, SimHash codes come back as int"""
+        key = self.key(base, **signer_key(signer))
+        sig = self.load(key)
+        if sig is None:
+            sig = np.asarray(signer.signature_from_hashes(xs), dtype=np.uint64)
+            self.save(key, sig)
+        return int(sig) if sig.ndim == 0 else sig
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes"""
+        entries = [(p.stat(), p) for p in self.root.glob("*/*.npy")]
+        total = sum(st.st_size for st, _ in entries)
+        for st, p in sorted(entries, key=lambda e: e[0].st_mtime):
+            if total <= self.max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            total -= st.st_size
+        return total
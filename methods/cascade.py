@@ -0,0 +1,238 @@
+import time
+from collections import Counter
+
+import numpy as np
+
+from methods.store import hashed_jaccard, SignatureArray
+from methods.lsh import rank_candidates
+
+# ------------------------------------------------------------ #
+# Staged candidate filter, cheap first:
+# SimHash -> MinHash bands -> MinHash estimate -> exact Jaccard
+# with MinHash signatures computed only where a stage needs them
+# ------------------------------------------------------------ #
+
+DUPLICATE = "duplicate" # stage verdict: stop, the doc is a duplicate
+
+class Probe:
+    """One incoming doc: fingerprint, SimHash code, MinHash signature and band keys (None until needed)"""
+    __slots__ = ("fp", "code", "sig", "keys")
+
+    def __init__(self, fp, code=None, sig=None):
+        self.fp, self.code, self.sig, self.keys = fp, code, sig, None
+
+class KeptDocs:
+    """
+    Kept docs as the stages see them: fingerprints (kept_shingles), SimHash codes,
+    MinHash signatures and band keys
+     - a doc may be kept without a signature, it is signed the first time a stage asks for it
+     - ensure(ids, probe) signs every missing row of ids (and the probe) in one vectorized call
+     - rows of a loaded index come in signed
+    """
+    def __init__(self, signer, lsh, fingerprints, signatures=None, band_keys=None, codes=None):
+        self.signer, self.lsh, self.fingerprints = signer, lsh, fingerprints
+        self.sigs = SignatureArray(signer.k, signatures)
+        self.keys = SignatureArray(len(lsh.bands), band_keys)
+        self.known = [True] * len(self.sigs)
+        self.codes = [None] * len(self.sigs) if codes is None else np.asarray(codes).tolist() # None = no SimHash stage
+        self.signed = 0 # signatures computed here
+
+    def __len__(self):
+        return len(self.sigs)
+
+    def append(self, probe):
+        known = probe.sig is not None
+        self.sigs.append(probe.sig if known else 0)
+        self.keys.append(probe.keys if probe.keys is not None else 0)
+        self.known.append(known)
+        if known and probe.keys is None:
+            self.keys.data[len(self) - 1] = self.lsh.band_keys(probe.sig)
+        self.codes.append(probe.code)
+
+    def ensure(self, ids=(), probe=None):
+        missing = [i for i in ids if not self.known[i]]
+        need = probe is not None and probe.sig is None
+        if missing or need:
+            docs = [self.fingerprints[i] for i in missing] + ([probe.fp] if need else [])
+            sigs = self.signer.signatures_from_hashes(docs)
+            self.signed += len(docs)
+            for i, sig in zip(missing, sigs):
+                self.sigs.data[i] = sig
+                self.keys.data[i] = self.lsh.band_keys(sig)
+                self.known[i] = True
+            if need:
+                probe.sig = sigs[-1]
+        if probe is not None and probe.keys is None:
+            probe.keys = self.lsh.band_keys(probe.sig)
+
+    def rows(self, ids):
+        return self.sigs.rows(ids)
+
+    def fill_index(self, store, names, start):
+        """store.add every doc kept from start on, in order (signs the rest first)"""
+        self.ensure(range(start, len(self)))
+        for i, name in enumerate(names, start):
+            store.add(name, self.sigs.data[i], self.keys.data[i], self.codes[i])
+
+class SimHashStage:
+    """Kept docs passing the SimHash gate (blocks or sorted index), generates or filters"""
+    name = "simhash"
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+
+    def __call__(self, probe, cands, kept):
+        out = self.blocks.candidates(probe.code)
+        return out if cands is None else out & set(cands)
+
+    def add(self, doc_id, probe, kept):
+        self.blocks.add(doc_id, probe.code)
+
+class BandStage:
+    """
+    Kept docs sharing a MinHash band with the probe
+     - index = True: query the LSH tables (a first stage, every kept doc is signed on insert)
+     - index = False: compare band keys with each surviving candidate, only candidates get signed
+       (needs a stage before it)
+    """
+    name = "lsh"
+
+    def __init__(self, lsh, index=True):
+        self.lsh, self.index = lsh, index
+
+    def __call__(self, probe, cands, kept):
+        if self.index:
+            kept.ensure((), probe)
+            out = self.lsh.query_keys(probe.keys)
+            return out if cands is None else out & set(cands)
+        ids = sorted(cands)
+        kept.ensure(ids, probe)
+        shared = (kept.keys.rows(ids) == np.array(probe.keys, dtype=np.uint64)).any(axis=1)
+        return set(np.array(ids)[shared].tolist())
+
+    def add(self, doc_id, probe, kept):
+        if self.index:
+            kept.ensure((), probe)
+            self.lsh.add_keys(doc_id, probe.keys)
+
+class EstimateStage:
+    """
+    Candidates ordered by MinHash-estimated Jaccard, most similar first
+     - margin (see lsh.estimate_margin): duplicate if the best estimate is above tau + margin,
+       candidates below tau - margin are dropped
+    """
+    name = "estimate"
+
+    def __init__(self, tau, margin=None):
+        self.tau, self.margin = tau, margin
+        self.decided = 0 # docs decided, or candidates pruned, on the estimate
+
+    def __call__(self, probe, cands, kept):
+        kept.ensure(cands, probe)
+        ids, est = rank_candidates(cands, probe.sig, kept)
+        if self.margin is None:
+            return ids
+        if est[0] >= self.tau + self.margin: # clear duplicate
+            self.decided += 1
+            return DUPLICATE
+        out = [i for i, e in zip(ids, est) if e >= self.tau - self.margin]
+        self.decided += len(out) < len(ids)
+        return out
+
+    def add(self, doc_id, probe, kept):
+        pass
+
+class ExactStage:
+    """Exact (fingerprint) Jaccard in candidate order, stops at the first >= tau"""
+    name = "exact"
+
+    def __init__(self, tau, verify=hashed_jaccard):
+        self.tau, self.verify = tau, verify
+        self.checked = 0
+
+    def __call__(self, probe, cands, kept):
+        for cand in (cands if isinstance(cands, list) else sorted(cands)):
+            self.checked += 1
+            if self.verify(probe.fp, kept.fingerprints[cand]) >= self.tau:
+                return [cand]
+        return []
+
+    def add(self, doc_id, probe, kept):
+        pass
+
+class Cascade:
+    """
+    Run stages in order, each on the candidates the previous one let through
+     - a stage is a callable (probe, cands, kept) -> surviving candidates or DUPLICATE
+       (cands = None for the first stage: it generates them), with a name and add(doc_id, probe, kept)
+     - no survivors = unique; survivors of the last stage = duplicate
+     - selectivity[stage] counts calls, candidates in / out, docs decided there and seconds
+    """
+    def __init__(self, stages, kept):
+        self.stages, self.kept = stages, kept
+        self.selectivity = {stage.name: Counter() for stage in stages}
+
+    def query(self, probe):
+        """True if probe is a duplicate of a kept doc"""
+        cands = None
+        for stage in self.stages:
+            sel = self.selectivity[stage.name]
+            sel["calls"] += 1
+            sel["in"] += len(self.kept) if cands is None else len(cands)
+            t0 = time.perf_counter_ns()
+            out = stage(probe, cands, self.kept)
+            sel["ns"] += time.perf_counter_ns() - t0
+            if out is DUPLICATE:
+                sel["duplicate"] += 1
+                return True
+            sel["out"] += len(out)
+            if not out:
+                sel["unique"] += 1
+                return False
+            cands = out
+        self.selectivity[self.stages[-1].name]["duplicate"] += 1
+        return True
+
+    def add(self, probe):
+        doc_id = len(self.kept)
+        for stage in self.stages:
+            stage.add(doc_id, probe, self.kept)
+        self.kept.append(probe)
+
+    def run(self, files, probes, kept_shingles, stats):
+        """Greedy accept loop over (path, Probe), returns kept paths in input order"""
+        kept_paths = []
+        for path, probe in zip(files, probes):
+            stats.tick()
+            if not self.query(probe):
+                self.add(probe)
+                kept_shingles.append(probe.fp)
+                kept_paths.append(path)
+        for name, sel in self.selectivity.items():
+            stats.add_time(f"cascade_{name}", sel["ns"], sel["calls"])
+            stats.count(f"cascade_{name}_in", sel["in"])
+            stats.count(f"cascade_{name}_out", sel["out"])
+        return kept_paths
+
+    def report(self):
+        """Per-stage selectivity: out / in, and docs decided at each stage"""
+        return {name: {"calls": sel["calls"], "in": sel["in"], "out": sel["out"],
+                       "selectivity": sel["out"] / sel["in"] if sel["in"] else 0.0,
+                       "unique": sel["unique"], "duplicate": sel["duplicate"], "seconds": sel["ns"] / 1e9}
+                for name, sel in self.selectivity.items()}
+
+    def describe(self):
+        return " -> ".join(f"{name} {sel['in']}:{sel['out']}" for name, sel in self.selectivity.items()) + \
+               f" (signed {self.kept.signed} lazily)"
+
+def sim_cascade(blocks, lsh, signer, kept_shingles, tau, margin=None, store=None, verify=hashed_jaccard):
+    """dedup_sim's filter: SimHash gate -> shared band (per candidate) -> estimate -> exact"""
+    loaded = store.loaded if store is not None else {}
+    kept = KeptDocs(signer, lsh, kept_shingles, loaded.get("signatures"), loaded.get("band_keys"), loaded.get("codes"))
+    return Cascade([SimHashStage(blocks), BandStage(lsh, index=False), EstimateStage(tau, margin), ExactStage(tau, verify)], kept)
+
+def lsh_cascade(lsh, signer, kept_shingles, tau, margin=None, store=None, verify=hashed_jaccard):
+    """dedup_lsh's filter: LSH tables -> estimate -> exact"""
+    loaded = store.loaded if store is not None else {}
+    kept = KeptDocs(signer, lsh, kept_shingles, loaded.get("signatures"), loaded.get("band_keys"))
+    return Cascade([BandStage(lsh, index=True), EstimateStage(tau, margin), ExactStage(tau, verify)], kept)
@@ -0,0 +1,200 @@
+import json
+import os
+from itertools import accumulate
+from bisect import bisect_right
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # optional, Parquet shards need it
+    pa = pq = None
+
+# ------------------------------------------------------------ #
+# Corpus I/O: a dir of .txt files, or JSONL / Parquet shards of
+# {"id", "text", "length"} records read lazily by position
+# ------------------------------------------------------------ #
+
+class Doc:
+    """
+    One record of a sharded corpus, text read on demand
+    Quacks like a Path where the dedup methods need it: name, read_text()
+    """
+    __slots__ = ("name", "size", "source", "pos")
+
+    def __init__(self, name, size, source, pos):
+        self.name = name # record id
+        self.size = size # length column, orders docs like st_size
+        self.source = source
+        self.pos = pos # (byte offset, byte length) of a JSONL line, or Parquet row
+
+    def read_text(self):
+        return self.source.read(self.pos)
+
+    def read_bytes(self):
+        return self.read_text().encode("utf-8")
+
+    def __repr__(self):
+        return f"Doc({self.name!r}, {self.size})"
+
+class _FdCache:
+    """LRU of read-only fds by path, closes the ones it evicts"""
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.fds = OrderedDict()
+
+    def __call__(self, path):
+        fd = self.fds.pop(path, None)
+        if fd is None:
+            if len(self.fds) >= self.maxsize:
+                os.close(self.fds.popitem(last=False)[1])
+            fd = os.open(path, os.O_RDONLY) # pread only, safe to share across forked workers
+        self.fds[path] = fd
+        return fd
+
+_fd = _FdCache()
+
+class JsonlShard:
+    """
+    One .jsonl file, one record per line
+     - docs() lists from the <shard>.idx.json sidecar written by write_shards (ids, sizes, line
+       offsets) when it is current, else decodes every line once
+    """
+    def __init__(self, path, id_field="id", text_field="text", length_field="length"):
+        self.path = str(path)
+        self.id_field, self.text_field, self.length_field = id_field, text_field, length_field
+
+    def docs(self):
+        index = Path(self.path + ".idx.json")
+        if index.exists() and index.stat().st_mtime >= os.stat(self.path).st_mtime:
+            idx = json.loads(index.read_text())
+            if idx["fields"] == [self.id_field, self.text_field, self.length_field]:
+                for name, size, offset, nbytes in zip(idx["ids"], idx["sizes"], idx["offsets"], idx["nbytes"]):
+                    yield Doc(name, size, self, (offset, nbytes))
+                return
+        stem = Path(self.path).stem
+        offset = 0
+        with open(self.path, "rb") as f:
+            for i, line in enumerate(f):
+                if line.strip():
+                    rec = json.loads(line)
+                    size = rec[self.length_field] if self.length_field in rec else len(rec[self.text_field])
+                    yield Doc(str(rec.get(self.id_field, f"{stem}-{i}")), size, self, (offset, len(line)))
+                offset += len(line)
+
+    def read(self, pos):
+        offset, size = pos
+        return json.loads(os.pread(_fd(self.path), size, offset))[self.text_field]
+
+@lru_cache(maxsize=64)
+def _row_group(path, group, field):
+    return pq.ParquetFile(path).read_row_group(group, columns=[field]).column(field)
+
+class ParquetShard:
+    """
+    One .parquet file, id/length columns read up front, text read one row group at a time
+     - size-ordered reads jump across shards: the last 64 row groups read stay cached,
+       so a read costs at most one row group of I/O (write_shards writes ROW_GROUP rows per group)
+    """
+    def __init__(self, path, id_field="id", text_field="text", length_field="length"):
+        if pq is None:
+            raise ImportError("Parquet shards need pyarrow")
+        self.path = str(path)
+        self.id_field, self.text_field, self.length_field = id_field, text_field, length_field
+        meta = pq.ParquetFile(self.path).metadata
+        rows = [meta.row_group(g).num_rows for g in range(meta.num_row_groups)]
+        self.starts = [sum(rows[:g]) for g in range(len(rows))] # first row of each group
+
+    def docs(self):
+        names = pq.read_schema(self.path).names
+        stem = Path(self.path).stem
+        size_field = self.length_field if self.length_field in names else self.text_field
+        table = pq.read_table(self.path, columns=[field for field in (self.id_field,) if field in names] + [size_field])
+        ids = table.column(self.id_field).to_pylist() if self.id_field in names else None
+        sizes = table.column(size_field).to_pylist()
+        if size_field == self.text_field:
+            sizes = [len(text) for text in sizes]
+        for i, size in enumerate(sizes):
+            yield Doc(str(ids[i]) if ids else f"{stem}-{i}", size, self, i)
+
+    def read(self, pos):
+        group = bisect_right(self.starts, pos) - 1
+        return _row_group(self.path, group, self.text_field)[pos - self.starts[group]].as_py()
+
+ROW_GROUP = 1000 # rows per Parquet row group written, bounds the I/O of one random read
+
+SHARDS = {".jsonl": JsonlShard, ".parquet": ParquetShard}
+
+def list_docs(indir, length=None, **fields):
+    """
+    Docs of a corpus, largest first, truncated to length
+     - a dir of .txt files -> Paths, sorted by st_size
+     - a dir of .jsonl / .parquet shards (or one shard file) -> Docs, sorted by the length column
+     - fields = id_field / text_field / length_field record keys
+    """
+    indir = Path(indir)
+    shards = [indir] if indir.is_file() else sorted(p for p in indir.iterdir() if p.suffix in SHARDS)
+    if shards:
+        docs = [doc for path in shards for doc in SHARDS[path.suffix](path, **fields).docs()]
+        docs.sort(key=lambda doc: doc.size, reverse=True)
+    else:
+        docs = sorted(indir.glob("*.txt"), key=lambda x: x.stat().st_size, reverse=True) # largest files first
+    if length:
+        docs = docs[:length]
+    return docs
+
+def write_shards(records, outdir, prefix="part", shard_size=10000, fmt="jsonl"):
+    """
+    Write dict records to numbered shards prefix-00000.jsonl|.parquet, returns the shard paths
+    JSONL shards get a <shard>.idx.json sidecar (see JsonlShard)
+    """
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    paths, batch = [], []
+
+    def flush():
+        path = outdir / f"{prefix}-{len(paths):05d}.{fmt}"
+        if fmt == "parquet":
+            if pq is None:
+                raise ImportError("Parquet shards need pyarrow")
+            pq.write_table(pa.Table.from_pylist(batch), path, row_group_size=ROW_GROUP)
+        else:
+            lines = [(json.dumps(rec) + "\n").encode("utf-8") for rec in batch]
+            with open(path, "wb") as f:
+                f.writelines(lines)
+            offsets = [0, *accumulate(len(line) for line in lines)][:-1]
+            idx = {"fields": ["id", "text", "length"], "offsets": offsets, "nbytes": [len(line) for line in lines],
+                   "ids": [str(rec.get("id", f"{path.stem}-{i}")) for i, rec in enumerate(batch)],
+                   "sizes": [rec["length"] if "length" in rec else len(rec["text"]) for rec in batch]}
+            Path(f"{path}.idx.json").write_text(json.dumps(idx)) # listing without decoding the text
+        paths.append(path)
+
+    for rec in records:
+        batch.append(rec)
+        if len(batch) == shard_size:
+            flush()
+            batch = []
+    if batch:
+        flush()
+    return paths
+
+def write_kept(docs, outdir, output="txt", shard_size=10000):
+    """
+    Write kept docs
+     - output = "txt": one file per doc (outdir/name)
+     - "manifest": outdir/kept.json, list of kept ids, nothing copied
+     - "jsonl" / "parquet": filtered shards kept-00000.*, {"id", "text", "length"} records
+    """
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    if output == "manifest":
+        (outdir / "kept.json").write_text(json.dumps([doc.name for doc in docs]))
+    elif output in ("jsonl", "parquet"):
+        records = ({"id": doc.name, "text": text, "length": len(text)} for doc in docs for text in [doc.read_text()])
+        write_shards(records, outdir, "kept", shard_size, output)
+    else:
+        for doc in docs:
+            name = doc.name if doc.name.endswith(".txt") else f"{doc.name}.txt"
+            (outdir / name).write_text(doc.read_text())
@@ -1,14 +1,32 @@
 import hashlib
-import json
+import os
+import shutil
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from methods.corpus import list_docs, write_kept
+
+try:
+    import xxhash # optional, faster non-cryptographic digest
+except ImportError:
+    xxhash = None
+
 def md5(path):
-    """Return the md5 hash of the file"""
-    return hashlib.md5(Path(path).read_bytes()).hexdigest()
+    """Return the md5 hash of the file (path or corpus.Doc)"""
+    data = path.read_bytes() if hasattr(path, "read_bytes") else Path(path).read_bytes()
+    return hashlib.md5(data).hexdigest()
 
-def exact_match(indir, outdir, length=None):
+def list_by_name(indir, length=None):
+    """Docs of a corpus (see corpus.list_docs) in name order, first copy of a duplicate wins"""
+    docs = sorted(list_docs(indir), key=lambda doc: doc.name)
+    return docs[:length] if length else docs
+
+def exact_match(indir, outdir, length=None, output="txt"):
     """
     Remove exact duplicates from input directory, saves in output directory
+     - indir = dir of .txt files or of JSONL/Parquet shards (see corpus.list_docs)
+     - output = "txt" files, "manifest" of kept ids, "jsonl" or "parquet" shards (see corpus.write_kept)
     """
     indir, outdir = Path(indir), Path(outdir)
     outdir.mkdir(parents=True, exist_ok=True)
@@ -16,9 +34,7 @@ def exact_match(indir, outdir, length=None):
     seen = set()
     kept = []
     
-    all_files = sorted(list(indir.glob("*.txt")))
-    if length:
-        all_files = all_files[:length]
+    all_files = list_by_name(indir, length)
     
     for path in all_files:
         md5_hash = md5(path)
@@ -30,8 +46,114 @@ def exact_match(indir, outdir, length=None):
     
     print(f"{len(kept)} unique files out of {len(all_files)} total files")
 
-    for path in kept:
-        (outdir / path.name).write_text(path.read_text())
+    write_kept(kept, outdir, output)
+
+def file_digest(path, algo="md5", chunk=1 << 20):
+    """
+    Digest of a file read in fixed-size chunks into one reused buffer
+     - algo = "md5", "blake2b" or "xxhash" (xxh3_128, needs the xxhash package)
+    """
+    if algo == "xxhash":
+        if xxhash is None:
+            raise ImportError("digest='xxhash' needs the xxhash package")
+        h = xxhash.xxh3_128()
+    else:
+        h = hashlib.new(algo)
+    if not isinstance(path, Path): # corpus.Doc, one record
+        h.update(path.read_bytes())
+        return h.hexdigest()
+    buf = bytearray(chunk)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while size := f.readinto(buf):
+            h.update(view[:size])
+    return h.hexdigest()
+
+FICLONE = 0x40049409 # linux ioctl: share extents (btrfs, xfs, ...)
+
+def copy_bytes(src, dst):
+    """Byte copy in the kernel (copy_file_range), no decode/encode"""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if hasattr(os, "copy_file_range"):
+            size = os.fstat(fsrc.fileno()).st_size
+            try:
+                while size > 0:
+                    sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size)
+                    if sent == 0:
+                        break
+                    size -= sent
+                return
+            except OSError: # unsupported fs pair, copy what is left in user space
+                pass
+        shutil.copyfileobj(fsrc, fdst)
+
+def reflink(src, dst):
+    """Copy-on-write clone, falls back to copy_bytes"""
+    try:
+        import fcntl
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (ImportError, OSError):
+        copy_bytes(src, dst)
+
+def hardlink(src, dst):
+    """Hard link, falls back to copy_bytes across devices"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy_bytes(src, dst)
+
+def exact_match_fast(indir, outdir, length=None, workers=8, digest="md5", output="copy", chunk=1 << 20):
+    """
+    Exact dedup for large directories, same kept set as exact_match
+     - group files by byte size, only files whose size collides are hashed
+       (records of a sharded corpus: by their length column)
+     - hash in chunk-sized reads on a thread pool (hashlib releases the GIL)
+     - digest = "md5", "blake2b" or "xxhash" (optional package)
+     - output = "hardlink", "reflink", "copy" (copy_file_range) or "manifest"
+       (outdir/kept.json of kept names, nothing copied); records of a sharded corpus are
+       written as .txt files for the file outputs, or "jsonl" / "parquet" shards (see corpus.write_kept)
+    """
+    indir, outdir = Path(indir), Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+
+    all_files = list_by_name(indir, length)
+
+    sizes = {path: path.stat().st_size if isinstance(path, Path) else path.size for path in all_files}
+    by_size = defaultdict(list)
+    for path in all_files:
+        by_size[sizes[path]].append(path)
+    to_hash = [path for group in by_size.values() if len(group) > 1 for path in group]
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        digests = dict(zip(to_hash, ex.map(lambda path: file_digest(path, digest, chunk), to_hash)))
+
+    seen = set()
+    kept = []
+    for path in all_files: # name order, first copy wins
+        key = (sizes[path], digests.get(path, path.name)) # unique size -> unique file
+        if key in seen:
+            continue
+        seen.add(key)
+        kept.append(path)
+
+    print(f"{len(kept)} unique files out of {len(all_files)} total files ({len(to_hash)} hashed)")
+
+    files = all(isinstance(path, Path) for path in kept)
+    if output in ("manifest", "jsonl", "parquet") or not files:
+        write_kept(kept, outdir, output if output in ("manifest", "jsonl", "parquet") else "txt")
+    else:
+        write = {"hardlink": hardlink, "reflink": reflink, "copy": copy_bytes}[output]
+
+        def put(path):
+            dst = outdir / path.name
+            dst.unlink(missing_ok=True) # links/clones need a fresh target
+            write(path, dst)
+
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(put, kept))
+
+    return {"unique_count": len(kept), "total_files": len(all_files), "hashed": len(to_hash)}
 
 if __name__ == "__main__":
     exact_match(indir="data/init/wiki", outdir="data/exact/wiki")
@@ -0,0 +1,73 @@
+import hashlib
+from functools import lru_cache
+
+import numpy as np
+
+from methods.jaccard import normalize_text, normalize_code, tokenize_code
+
+MAX64 = 2**64 - 1
+
+def hash64(data): # bytes ->64 bit integer hash
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big", signed=False)
+
+def encode_shingle(x):
+    """Add length prefix to shingle"""
+    if isinstance(x, tuple): # code
+        encode = []
+        for token in x:
+            b = token.encode("utf-8") # byte
+            encode.append(str(len(b)).encode('ascii') + b':' + b)
+        return b'|'.join(encode)
+    return x.encode("utf-8")
+
+def hash_shingles(it):
+    """Hash shingles into a uint64 array (one Blake2b per shingle)"""
+    return np.fromiter((hash64(encode_shingle(x)) for x in it), dtype=np.uint64)
+
+def fingerprint(it):
+    """Compact shingle fingerprint: sorted unique uint64 shingle hashes"""
+    return np.unique(hash_shingles(it))
+
+# ------------------------------------------------------------ #
+# Rolling shingle hashes
+# ------------------------------------------------------------ #
+
+BASE = np.uint64(0x100000001B3) # odd multiplier, polynomial hash mod 2^64
+
+def mix64(x):
+    """splitmix64 finalizer, spreads polynomial hash bits over all 64 bits"""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def rolling_hashes(values, n):
+    """
+    Polynomial (Rabin-Karp) hash of every n-window of a uint64 sequence,
+    h_i = sum_j values[i+j] * BASE^(n-1-j) mod 2^64, all windows at once
+    Returns sorted unique mixed hashes
+    """
+    m = len(values) - n + 1
+    if m <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    h = np.zeros(m, dtype=np.uint64)
+    for j in range(n):
+        h = h * BASE + values[j:j + m]
+    return np.unique(mix64(h))
+
+def rolling_char_hashes(text, k):
+    """Hashes of char k-shingles over code points, no substrings built"""
+    return rolling_hashes(np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64), k)
+
+@lru_cache(maxsize=1 << 16)
+def token_id(token):
+    return hash64(token.encode("utf-8"))
+
+def rolling_token_hashes(tokens, n):
+    """Hashes of token n-shingles over per-token ids, no tuples built"""
+    return rolling_hashes(np.fromiter((token_id(t) for t in tokens), dtype=np.uint64, count=len(tokens)), n)
+
+def shingle_hashes(text, n=10, type="text", lexer="tokenize"):
+    """Rolling-hash counterpart of jaccard.shingle: one pass, returns sorted unique uint64"""
+    if type == "text":
+        return rolling_char_hashes(normalize_text(text), n)
+    return rolling_token_hashes(tokenize_code(normalize_code(text), lexer), n)
@@ -0,0 +1,132 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from methods.store import ShingleArena
+
+INDEX_VERSION = 1
+
+class Index:
+    """
+    Persistent index of kept documents for incremental dedup across runs
+
+    Stored as flat arrays in a directory, loaded memory-mapped:
+     - meta.json: run params, must match to append
+     - ids.json: kept document names
+     - signatures.npy: (n, k) MinHash signatures
+     - band_keys.npy: (n, bands) LSH band hashes, rebuild tables without rehashing
+     - codes.npy: (n,) SimHash codes (dedup_sim only)
+     - shingles.npy / offsets.npy: fingerprints of kept docs, for verification
+     - manifest.json: the generation of ids / arrays to load; save() writes a new generation
+       (ids.<gen>.json, <name>.<gen>.npy) and swaps the manifest in last, so a crash mid-save
+       leaves the previous snapshot whole
+    """
+    def __init__(self, meta):
+        self.meta = meta
+        self.ids = []
+        self.signatures = []
+        self.band_keys = []
+        self.codes = []
+        self.shingles = ShingleArena()
+        self.loaded = {} # memory-mapped arrays of a previous run
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def open(cls, path, meta, append=False):
+        """New index, or existing one at path if append (params must match)"""
+        path = Path(path)
+        meta = {"version": INDEX_VERSION, **meta}
+        if not append or not (path / "meta.json").exists():
+            return cls(meta)
+        index = cls.load(path)
+        if index.meta != meta:
+            raise ValueError(f"index params {index.meta} do not match run params {meta}")
+        return index
+
+    @classmethod
+    def load(cls, path):
+        path = Path(path)
+        index = cls(json.loads((path / "meta.json").read_text()))
+        files = _manifest(path)["files"]
+        index.ids = json.loads((path / files["ids"]).read_text())
+        for name in ("signatures", "band_keys", "codes"):
+            if name in files:
+                index.loaded[name] = np.load(path / files[name], mmap_mode="r")
+        index.shingles = ShingleArena(
+            np.load(path / files["shingles"], mmap_mode="r"),
+            np.load(path / files["offsets"], mmap_mode="r"),
+        )
+        return index
+
+    def add(self, doc_id, signature, band_keys, code=None):
+        """Record a newly kept doc (its fingerprint goes to self.shingles)"""
+        self.ids.append(doc_id)
+        self.signatures.append(signature)
+        self.band_keys.append(band_keys)
+        if code is not None:
+            self.codes.append(code)
+
+    def fill(self, lsh, blocks=None):
+        """Insert loaded docs into fresh LSH (and SimHash block) tables"""
+        keys = self.loaded.get("band_keys")
+        if keys is not None:
+            lsh.add_many(np.arange(len(keys)), keys)
+        codes = self.loaded.get("codes")
+        if blocks is not None and codes is not None:
+            for doc_id, code in enumerate(codes.tolist()):
+                blocks.add(doc_id, code)
+
+    def _rows(self, name, new, dtype, width=None):
+        """Loaded + new rows as (n, width), or (n,) if width is None, also when there are none"""
+        rows = np.array([np.asarray(x, dtype=dtype) for x in new], dtype=dtype).reshape(-1, *(() if width is None else (width,)))
+        if name in self.loaded:
+            return np.concatenate([self.loaded[name], rows])
+        return rows
+
+    def save(self, path):
+        """Write a new generation of ids and arrays, then swap the manifest to it (atomic)"""
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        old = _manifest(path)
+        gen = old["generation"] + 1
+        arena, offsets = self.shingles.flat()
+        arrays = {
+            "signatures": self._rows("signatures", self.signatures, np.uint64, self.meta["k"]),
+            "band_keys": self._rows("band_keys", self.band_keys, np.uint64, self.meta["k"] // self.meta["r"]),
+            "shingles": arena,
+            "offsets": offsets,
+        }
+        if self.codes or "codes" in self.loaded:
+            arrays["codes"] = self._rows("codes", self.codes, np.uint64)
+        files = {"ids": f"ids.{gen}.json"}
+        _write(path / files["ids"], json.dumps(self.ids))
+        for name, arr in arrays.items():
+            files[name] = f"{name}.{gen}.npy"
+            with open(path / files[name], "wb") as f:
+                np.save(f, arr)
+                f.flush()
+                os.fsync(f.fileno())
+        _write(path / "meta.json", json.dumps(self.meta), replace=True)
+        _write(path / "manifest.json", json.dumps({"generation": gen, "files": files}), replace=True)
+        for name in set(old["files"].values()) - set(files.values()): # previous generation (mmaps stay valid)
+            (path / name).unlink(missing_ok=True)
+
+def _manifest(path):
+    """Current generation and its files (generation 0, no files: nothing saved yet)"""
+    if (path / "manifest.json").exists():
+        return json.loads((path / "manifest.json").read_text())
+    return {"generation": 0, "files": {}}
+
+def _write(file, text, replace=False):
+    """Write and fsync text, via a temp file and os.replace if replace"""
+    tmp = file.with_name(file.name + ".tmp") if replace else file
+    with open(tmp, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    if replace:
+        os.replace(tmp, file)
@@ -0,0 +1,150 @@
+import cProfile
+import io
+import json
+import pstats
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+# ------------------------------------------------------------ #
+# Opt-in instrumentation: stage timers, counters, histograms
+# ------------------------------------------------------------ #
+
+class Stats:
+    """
+    Cumulative per-stage timers, counters and power-of-two histograms for a dedup run
+     - with stats.time("verify"): ... adds wall time (perf_counter_ns) and a call to the stage
+     - stats.count("verify_hit"), stats.observe("candidates", len(cands))
+     - stats.tick() once per doc: calls progress(snapshot) every `every` seconds
+     - profile = stage names to run under profiler (cProfile.Profile by default, or any
+       object with enable()/disable(), e.g. a sampling profiler adapter)
+     - to_json() / to_prometheus() for export
+    Stages timed in worker processes are summed into the same timers (CPU time across workers)
+    """
+    enabled = True
+
+    def __init__(self, progress=None, every=10.0, profile=(), profiler=None):
+        self.timers = defaultdict(int) # stage -> ns
+        self.calls = Counter()
+        self.counters = Counter()
+        self.hists = defaultdict(Counter) # name -> {bit_length: count}
+        self.sums = Counter()
+        self.docs = 0
+        self.start = time.perf_counter()
+        self.progress, self.every = progress, every
+        self.last = self.start
+        self.profile = set(profile)
+        self.profiler = profiler if profiler is not None else (cProfile.Profile() if self.profile else None)
+
+    @contextmanager
+    def time(self, stage):
+        prof = self.profiler if stage in self.profile else None
+        if prof is not None:
+            prof.enable()
+        t0 = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.timers[stage] += time.perf_counter_ns() - t0
+            self.calls[stage] += 1
+            if prof is not None:
+                prof.disable()
+
+    def add_time(self, stage, ns, calls=1):
+        self.timers[stage] += ns
+        self.calls[stage] += calls
+
+    def merge_timers(self, timers):
+        """Add {stage: (ns, calls)} measured elsewhere (worker processes)"""
+        for stage, (ns, calls) in timers.items():
+            self.add_time(stage, ns, calls)
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, name, value):
+        self.hists[name][int(value).bit_length()] += 1 # bucket b holds values <= 2^b - 1
+        self.sums[name] += value
+
+    def tick(self, docs=1):
+        self.docs += docs
+        if self.progress is not None:
+            now = time.perf_counter()
+            if now - self.last >= self.every:
+                self.last = now
+                self.progress(self.snapshot())
+
+    def snapshot(self):
+        elapsed = time.perf_counter() - self.start
+        return {"docs": self.docs, "elapsed": elapsed, "docs_per_sec": self.docs / elapsed if elapsed else 0.0,
+                **dict(self.counters)}
+
+    def histogram(self, name):
+        """Cumulative (upper bound, count) buckets"""
+        hist, total, out = self.hists[name], 0, []
+        for b in range(max(hist, default=0) + 1):
+            total += hist[b]
+            out.append(((1 << b) - 1, total))
+        return out
+
+    def to_json(self):
+        return {
+            **self.snapshot(),
+            "stages": {stage: {"seconds": ns / 1e9, "calls": self.calls[stage]} for stage, ns in self.timers.items()},
+            "counters": dict(self.counters),
+            "histograms": {name: {"buckets": self.histogram(name), "sum": self.sums[name],
+                                  "count": sum(self.hists[name].values())} for name in self.hists},
+        }
+
+    def dumps(self):
+        return json.dumps(self.to_json(), indent=1)
+
+    def to_prometheus(self, prefix="dedup"):
+        """Prometheus text exposition format"""
+        lines = [f"# TYPE {prefix}_stage_seconds_total counter"]
+        lines += [f'{prefix}_stage_seconds_total{{stage="{s}"}} {ns / 1e9}' for s, ns in self.timers.items()]
+        lines.append(f"# TYPE {prefix}_stage_calls_total counter")
+        lines += [f'{prefix}_stage_calls_total{{stage="{s}"}} {c}' for s, c in self.calls.items()]
+        lines += [f"# TYPE {prefix}_docs_total counter", f"{prefix}_docs_total {self.docs}"]
+        for name, value in self.counters.items():
+            lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+        for name in self.hists:
+            lines.append(f"# TYPE {prefix}_{name} histogram")
+            lines += [f'{prefix}_{name}_bucket{{le="{le}"}} {count}' for le, count in self.histogram(name)]
+            count = sum(self.hists[name].values())
+            lines += [f'{prefix}_{name}_bucket{{le="+Inf"}} {count}',
+                      f"{prefix}_{name}_sum {self.sums[name]}", f"{prefix}_{name}_count {count}"]
+        return "\n".join(lines) + "\n"
+
+    def profile_report(self, sort="cumulative", limit=30):
+        """pstats text of the profiled stages (cProfile only)"""
+        if not isinstance(self.profiler, cProfile.Profile):
+            return ""
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+class NullStats:
+    """Disabled Stats: same interface, no work"""
+    enabled = False
+    _null = nullcontext()
+
+    def time(self, stage):
+        return self._null
+
+    def add_time(self, stage, ns, calls=1):
+        pass
+
+    def merge_timers(self, timers):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def tick(self, docs=1):
+        pass
+
+NULL_STATS = NullStats()
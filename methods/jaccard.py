@@ -1,7 +1,11 @@
 from pathlib import Path
 import re, unicodedata
-import keyword, tokenize
+import keyword, token, tokenize
 import io
+import math
+from collections import Counter, defaultdict
+
+from methods.corpus import list_docs, write_kept
 
 def normalize_text(text):
     """NFKC normalization + collapse spaces"""
@@ -24,7 +28,126 @@ def tokenize_text(text):
     text = re.sub(r"[^\w]+", " ", text)
     return [w.lower() for w in text.split() if w]
 
-def tokenize_code(code):
+_PREFIX = r"(?:[bB][rR]|[rR][bB]|[fF][rR]|[rR][fF]|[bBrRuUfF])?" # string prefixes
+_SQ3 = r"'''[^'\\]*(?:(?:\\[\s\S]|'(?!''))[^'\\]*)*'''"
+_DQ3 = r'"""[^"\\]*(?:(?:\\[\s\S]|"(?!""))[^"\\]*)*"""'
+_SQ = r"'[^\n'\\]*(?:\\(?:\r\n|[\s\S])[^\n'\\]*)*'"
+_DQ = r'"[^\n"\\]*(?:\\(?:\r\n|[\s\S])[^\n"\\]*)*"'
+
+def _operators():
+    """Operator alternation, longest first, single chars as one class"""
+    ops = sorted(token.EXACT_TOKEN_TYPES, key=len, reverse=True)
+    multi = [re.escape(op) for op in ops if len(op) > 1]
+    single = "".join(re.escape(op) for op in ops if len(op) == 1 and op != ".")
+    return "|".join(multi + [rf"[{single}]", r"\.(?![0-9])"]) # ".5" is a number
+
+# ordered by frequency; branches that could match at the same position keep tokenize's precedence
+_CODE_TOKEN = re.compile("|".join([
+    r"(?P<ws>[ \f\t]+)",
+    r"(?P<id>(?![bBrRuUfF]{0,2}['\"])[^\W\d]\w*)", # names, except possible string prefixes
+    rf"(?P<op>{_operators()})",
+    r"(?P<nl>\r?\n)",
+    rf"(?P<num>{tokenize.Number})",
+    r"(?P<comment>#[^\r\n]*)",
+    r"(?P<cont>\\\r?\n)",
+    rf"(?P<str3>{_PREFIX}(?:{_SQ3}|{_DQ3}))",
+    rf"(?P<open>{_PREFIX}(?:'''|\"\"\")[\s\S]*)", # unterminated triple-quoted string
+    rf"(?P<str>{_PREFIX}(?:{_SQ}|{_DQ}))",
+    r"(?P<name>\w+)",
+    r"(?P<err>[\s\S])",
+]))
+
+def _indent_width(ws):
+    column = 0
+    for ch in ws:
+        if ch == " ":
+            column += 1
+        elif ch == "\t":
+            column = (column // 8 + 1) * 8
+        else: # form feed
+            column = 0
+    return column
+
+def lex_code(code):
+    """
+    Single-pass regex lexer, same token stream as tokenize_code on well-formed Python
+     - NEWLINE/INDENT/DEDENT rules follow the stdlib tokenizer (blank and comment lines,
+       brackets, backslash continuation, implicit NEWLINE at EOF)
+     - malformed input degrades instead of failing: unclosed brackets/strings keep
+       the tokens so far, stray characters are emitted as themselves
+    """
+    code = unicodedata.normalize("NFKC", code)
+    tokens = []
+    indents = [0]
+    depth = 0 # bracket depth
+    line_start = True # at the start of a physical line
+    continued = False # previous line ended with a backslash
+    pending = None # indent column of a new statement, until its first token
+    for m in _CODE_TOKEN.finditer(code):
+        kind = m.lastgroup
+        if line_start:
+            line_start = False
+            if depth == 0 and not continued:
+                pending = _indent_width(m.group()) if kind == "ws" else 0
+            continued = False
+        if kind == "ws" or kind == "comment":
+            continue
+        if kind == "nl":
+            line_start = True
+            if pending is not None: # blank or comment-only line
+                pending = None
+            elif depth <= 0:
+                tokens.append("NL")
+            continue
+        if pending is not None: # first token of a statement
+            if pending > indents[-1]:
+                indents.append(pending)
+                tokens.append("IND")
+            while pending < indents[-1]:
+                indents.pop()
+                tokens.append("DED")
+            pending = None
+
+        if kind == "cont":
+            line_start = continued = True
+        elif kind == "id" or kind == "name":
+            tok = m.group()
+            if not tok[0].isidentifier():
+                tokens.append(tok)
+            elif keyword.iskeyword(tok):
+                tokens.append(f"KW_{tok}")
+            else:
+                tokens.append("ID")
+        elif kind == "op":
+            tok = m.group()
+            if tok in "([{":
+                depth += 1
+            elif tok in ")]}":
+                depth -= 1
+            tokens.append(tok)
+        elif kind == "num":
+            tokens.append("NUM")
+        elif kind == "err":
+            tok = m.group().strip()
+            if tok:
+                tokens.append(tok)
+        else: # str, str3, open
+            tokens.append("STR")
+
+    tail = code[code.rfind("\n") + 1:].strip() # implicit NEWLINE if no trailing newline
+    if tail and not tail.startswith("#") and code[-1] != "\r":
+        tokens.append("NL")
+    tokens.extend("DED" for _ in indents[1:])
+    return tokens
+
+def tokenize_code(code, lexer="tokenize"):
+    """
+    Map code to token classes (ID, STR, NUM, KW_*, NL, IND, DED, punctuation)
+     - lexer = "tokenize": stdlib tokenizer, [] on TokenError
+     - lexer = "regex": lex_code, faster and keeps malformed snippets
+    """
+    if lexer == "regex":
+        return lex_code(code)
     code = unicodedata.normalize("NFKC", code)
     tokens = []
     try:
@@ -73,41 +196,141 @@ def ngram_char_shingling(text, k=5):
         return set()
     return {text[i:i+k] for i in range(len(text)-k+1)}
 
-def dedup_jaccard(indir, outdir, n=10, type="text", tau=0.5, length=None):
+def shingle(text, n=10, type="text", lexer="tokenize"):
+    """
+    Normalize, tokenize and shingle a document, returns set
+    text = char-n shingles, code = token-n shingles
+    """
+    if type == "text":
+        return ngram_char_shingling(normalize_text(text), n)
+    return ngram_token_shingling(tokenize_code(normalize_code(text), lexer), n)
+
+EPS = 1e-9 # keep float thresholds conservative
+
+def min_overlap(tau, size):
+    """Smallest overlap any set with J >= tau against a set of this size can have"""
+    return math.ceil(tau * size - EPS)
+
+class PrefixIndex:
+    """
+    Exact Jaccard similarity join (AllPairs / PPJoin filters)
+
+    Docs are lists of shingle ranks sorted by global rarity (rarest first)
+     - prefix: J >= tau => the first |x| - ceil(tau|x|) + 1 ranks of both share one
+     - size: tau|A| <= |B| <= |A|/tau
+     - positional: overlap so far + remaining suffix must reach tau/(1+tau)(|A|+|B|)
+    Survivors are verified with exact jaccard
+    """
+    def __init__(self, tau):
+        assert tau > 0
+        self.tau = tau
+        self.index = defaultdict(list) # rank -> [(doc_id, position)]
+        self.sizes = []
+
+    def prefix(self, size):
+        return max(0, size - min_overlap(self.tau, size) + 1)
+
+    def candidates(self, ranks):
+        """Kept docs passing prefix, size and positional filters"""
+        tau, size = self.tau, len(ranks)
+        overlap = {} # doc_id -> overlap in prefixes so far, None = pruned
+        for i in range(min(self.prefix(size), size)):
+            for doc_id, j in self.index.get(ranks[i], []):
+                count = overlap.get(doc_id, 0)
+                if count is None:
+                    continue
+                other = self.sizes[doc_id]
+                if other < min_overlap(tau, size) or size < min_overlap(tau, other): # size filter
+                    overlap[doc_id] = None
+                    continue
+                alpha = math.ceil(tau / (1 + tau) * (size + other) - EPS)
+                if count + 1 + min(size - i - 1, other - j - 1) >= alpha: # positional filter
+                    overlap[doc_id] = count + 1
+                else:
+                    overlap[doc_id] = None
+        return [doc_id for doc_id, count in overlap.items() if count]
+
+    def add(self, ranks):
+        doc_id = len(self.sizes)
+        self.sizes.append(len(ranks))
+        for j in range(min(self.prefix(len(ranks)), len(ranks))):
+            self.index[ranks[j]].append((doc_id, j))
+        return doc_id
+
+def dedup_jaccard(indir, outdir, n=10, type="text", tau=0.5, length=None, engine="scan", lexer="tokenize",
+                  cache=None, cache_bytes=1 << 30, output="txt"):
     """
     Deduplicate files using Jaccard similarity
+     - engine = "scan": compare against every kept doc, O(n^2)
+     - engine = "prefix": inverted index with prefix/size/positional filters,
+       same kept set (two passes: global shingle frequencies, then greedy join)
+     - lexer = "tokenize" or "regex" code tokenizer
+     - cache = dir of a content-addressed DocCache (see cache.py), shingle sets become
+       sets of their 64-bit hashes, bounded to cache_bytes
+     - indir = dir of .txt files or of JSONL/Parquet shards (see corpus.list_docs)
+     - output = "txt" files, "manifest" of kept ids, "jsonl" or "parquet" shards (see corpus.write_kept)
     """
-    # TODO: speed up comparisons, currently O(n^2)
-    # approximate with minhash lsh?
     indir, outdir = Path(indir), Path(outdir)
     outdir.mkdir(parents=True, exist_ok=True)
-    
-    norm_data = normalize_text if type == "text" else normalize_code
+
+    doc_shingles = lambda path: shingle(path.read_text(), n, type, lexer)
+    if cache is not None:
+        from methods.cache import DocCache # cache builds on shingle
+        doc_cache = DocCache(cache, max_bytes=cache_bytes)
+        doc_shingles = lambda path: set(doc_cache.shingles(path, n, type, lexer=lexer)[1].tolist())
     
     kept_paths = []
     kept_shingles = []
+    total_pairs = 0
     
-    all_files = sorted(indir.glob("*.txt"), key=lambda x: x.stat().st_size, reverse=True)
-    if length:
-        all_files = all_files[:length]
-    
-    for path in all_files:
-        text = path.read_text()
-        text = norm_data(text)
-        tokens = tokenize_text(text) if type == "text" else tokenize_code(text)
-        sh = ngram_char_shingling(text, n) if type == "text" else ngram_token_shingling(tokens, n)
-        if any(jaccard(sh, kept_sh) >= tau for kept_sh in kept_shingles):
-            print(f"Duplicate found: {path.name}")
-            continue
-        kept_shingles.append(sh)
-        kept_paths.append(path)
+    all_files = list_docs(indir, length) # largest first
+
+    if engine == "prefix" and tau > 0:
+        # global rarity order: rarest shingles first, ties by value
+        df = Counter()
+        for path in all_files:
+            df.update(doc_shingles(path))
+        rank = {x: i for i, x in enumerate(sorted(df, key=lambda x: (df[x], x)))}
+        del df
+        index = PrefixIndex(tau)
+
+        for path in all_files:
+            ranks = sorted(rank[x] for x in doc_shingles(path))
+            sh = set(ranks)
+            keep = True
+            for doc_id in index.candidates(ranks):
+                total_pairs += 1
+                if jaccard(sh, kept_shingles[doc_id]) >= tau:
+                    keep = False
+                    break
+            if not keep:
+                print(f"Duplicate found: {path.name}")
+                continue
+            index.add(ranks)
+            kept_shingles.append(sh)
+            kept_paths.append(path)
+    else:
+        for path in all_files:
+            sh = doc_shingles(path)
+            keep = True
+            for kept_sh in kept_shingles:
+                total_pairs += 1
+                if jaccard(sh, kept_sh) >= tau:
+                    keep = False
+                    break
+            if not keep:
+                print(f"Duplicate found: {path.name}")
+                continue
+            kept_shingles.append(sh)
+            kept_paths.append(path)
     
     print(f"{len(kept_paths)} unique files out of {len(all_files)} total files")
+    if cache is not None:
+        doc_cache.evict()
     
-    for path in kept_paths:
-        (outdir / path.name).write_text(path.read_text())
+    write_kept(kept_paths, outdir, output)
     
-    return {"unique_count": len(kept_paths), "total_files": len(all_files)}
+    return {"unique_count": len(kept_paths), "total_files": len(all_files), "pairs_checked": total_pairs}
 
 if __name__ == "__main__":
     dedup_jaccard(indir="data/exact/wiki", outdir="data/jaccard/wiki", n=4, type="text", tau=0.30, length = 1000)
@@ -5,6 +5,9 @@ import io
 import hashlib
 import random
 from collections import defaultdict
+from itertools import islice
+
+import numpy as np
 
 from methods.jaccard import (
     normalize_text, normalize_code,
@@ -12,21 +15,12 @@ from methods.jaccard import (
     ngram_char_shingling, ngram_token_shingling,
     jaccard
 )
-
-MAX64 = 2**64 - 1
-
-def hash64(data): # bytes ->64 bit integer hash
-    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big", signed=False)
-
-def encode_shingle(x):
-    """Add length prefix to shingle"""
-    if isinstance(x, tuple): # code
-        encode = []
-        for token in x:
-            b = token.encode("utf-8") # byte
-            encode.append(str(len(b)).encode('ascii') + b':' + b)
-        return b'|'.join(encode)
-    return x.encode("utf-8")
+from methods.hashing import MAX64, hash64, encode_shingle, hash_shingles, fingerprint, mix64
+from methods.store import hashed_jaccard, ShingleArena, SignatureArray, SpillStore
+from methods.pipeline import sign_files
+from methods.index import Index
+from methods.corpus import list_docs, write_kept
+from methods.instrument import NULL_STATS
 
 def stream_char(text, k):
     for i in range(max(0, len(text) - k + 1)):
@@ -44,28 +38,139 @@ class MinHash:
     """
     Approximate Jaccard using MinHash
     Simulate k random permutations:
-     - h_i(x) = Hash(seed_i || encode_shingle(x))
+     - h_i(x) = a_i * Hash(encode_shingle(x)) + b_i mod 2^64
+    Vectorized over (shingles x k), chunked to bound memory
     """
-    def __init__(self, k=128, seed=42):
+    def __init__(self, k=128, seed=42, chunk=4096):
         self.k = k # num of hash functions
+        self.chunk = chunk # max shingles per (chunk x k) block
+        self.seed = seed
         rand = random.Random(seed)
         #self.hashes = [rand.getrandbits(64).to_bytes(8, 'big') for _ in range(k)]
         self.a = [rand.getrandbits(64) | 1 for _ in range(k)] # coprime to MAX64
         self.b = [rand.getrandbits(64) for _ in range(k)]
-    
+        self._a = np.array(self.a, dtype=np.uint64)
+        self._b = np.array(self.b, dtype=np.uint64)
+
+    def _permute(self, x):
+        """(len(x), k) block of a*x+b, uint64 arithmetic wraps mod 2^64"""
+        return x[:, None] * self._a + self._b
+
+    def signature_from_hashes(self, xs):
+        """
+        Keep min hash value across hashes for one document of shingle hashes
+        """
+        sig = np.full(self.k, MAX64, dtype=np.uint64) # store min hash val
+        for start in range(0, len(xs), self.chunk):
+            block = self._permute(xs[start:start + self.chunk])
+            np.minimum(sig, block.min(axis=0), out=sig)
+        return sig
+
     def signature_from_iter(self, it):
         """
         Keep min hash value across hashes for each document
         """
-        signatures = [MAX64] * self.k # store min hash val
-        a, b = self.a, self.b
-        for shingle in it:
-            x = hash64(encode_shingle(shingle)) # one Black2b per shingle
-            for idx in range(self.k):
-                h = (a[idx] * x + b[idx]) & MAX64
-                if h < signatures[idx]:
-                    signatures[idx] = h
-        return tuple(signatures)
+        return self.signature_from_hashes(hash_shingles(it))
+
+    def signatures_from_hashes(self, docs):
+        """
+        Batch signatures for many documents of shingle hashes, returns (len(docs), k)
+         - small docs are packed together and reduced per document with reduceat
+        """
+        out = np.full((len(docs), self.k), MAX64, dtype=np.uint64)
+        batch = [] # (row, hashes) of docs packed in current block
+        size = 0
+
+        def flush():
+            xs = np.concatenate([x for _, x in batch])
+            offsets = np.cumsum([0] + [len(x) for _, x in batch[:-1]])
+            rows = [row for row, _ in batch]
+            out[rows] = np.minimum.reduceat(self._permute(xs), offsets, axis=0)
+
+        for row, xs in enumerate(docs):
+            if len(xs) == 0: # empty doc keeps MAX64
+                continue
+            if len(xs) >= self.chunk: # large doc chunked on its own
+                out[row] = self.signature_from_hashes(xs)
+                continue
+            if size + len(xs) > self.chunk:
+                flush()
+                batch, size = [], 0
+            batch.append((row, xs))
+            size += len(xs)
+        if batch:
+            flush()
+        return out
+
+    def signatures_from_iters(self, its):
+        """Batch signatures for many documents of shingles"""
+        return self.signatures_from_hashes([hash_shingles(it) for it in its])
+
+class OnePermutationHash:
+    """
+    One-permutation MinHash (OPH) with optimal densification
+     - each shingle hashed once: h = mix64(a*x + b), the high bits pick one of k bins,
+       each bin keeps its min h
+     - an empty bin copies a non-empty bin found by its own probe sequence,
+       hash(bin, attempt) (Shrivastava 2017)
+    Cost O(|shingles| + k) instead of O(|shingles| * k), same (k,) uint64 signature as MinHash
+    """
+    def __init__(self, k=128, seed=42):
+        self.k = k
+        self.seed = seed
+        rand = random.Random(seed)
+        self.a = np.uint64(rand.getrandbits(64) | 1)
+        self.b = np.uint64(rand.getrandbits(64))
+        self.salt = np.uint64(rand.getrandbits(64)) # probe sequences
+
+    def _bin(self, h):
+        """Map uint64 hashes to 0..k-1 by their high 32 bits"""
+        return (((h >> np.uint64(32)) * np.uint64(self.k)) >> np.uint64(32)).astype(np.intp)
+
+    def signature_from_hashes(self, xs):
+        sig = np.full(self.k, MAX64, dtype=np.uint64)
+        if len(xs) == 0: # empty doc keeps MAX64
+            return sig
+        h = mix64(xs * self.a + self.b)
+        bins = self._bin(h)
+        np.minimum.at(sig, bins, h)
+
+        filled = np.zeros(self.k, dtype=bool)
+        filled[bins] = True
+        empty = np.flatnonzero(~filled)
+        step = 2 * self.k // len(np.unique(bins)) + 1 # attempts per round, ~2 expected hits each
+        attempt = 1
+        while len(empty): # densify
+            attempts = np.arange(attempt, attempt + step, dtype=np.uint64)
+            probe = mix64(((empty.astype(np.uint64)[:, None] << np.uint64(32)) + attempts) ^ self.salt)
+            src = self._bin(probe)
+            hit = filled[src]
+            found = hit.any(axis=1)
+            first = hit.argmax(axis=1)[found] # first non-empty bin in each probe sequence
+            sig[empty[found]] = sig[src[found, first]]
+            empty = empty[~found]
+            attempt += step
+        return sig
+
+    def signature_from_iter(self, it):
+        return self.signature_from_hashes(hash_shingles(it))
+
+    def signatures_from_hashes(self, docs):
+        out = np.full((len(docs), self.k), MAX64, dtype=np.uint64)
+        for row, xs in enumerate(docs):
+            out[row] = self.signature_from_hashes(xs)
+        return out
+
+    def signatures_from_iters(self, its):
+        return self.signatures_from_hashes([hash_shingles(it) for it in its])
+
+def make_signer(signer="minhash", k=128, seed=42):
+    """signer = "minhash" (k permutations) or "oph" (one permutation + densification)"""
+    if signer == "minhash":
+        return MinHash(k=k, seed=seed)
+    if signer == "oph":
+        return OnePermutationHash(k=k, seed=seed)
+    raise ValueError(f"unknown signer {signer!r}")
 
 class LSH:
     """
@@ -73,6 +178,8 @@ class LSH:
      - Band match iff all rows match, prob = J^r
      - Candidate prob -> 1 - (1 - J^r)^b
     """
+    batched = False # query_many / add_many loop over the dict tables, nothing gained batching
+
     def __init__(self, k=128, r=4):
         assert k % r == 0
         self.k = k
@@ -86,87 +193,465 @@ class LSH:
         band_bytes = b','.join(int(signature[i]).to_bytes(8, 'big') for i in range(start, end))
         return hash64(band_bytes)
     
+    def band_keys(self, signature):
+        """Band hash for each band"""
+        return [self.band_hash(signature, start, end) for start, end in self.bands]
+
     def candidates(self, signatures):
         """For each band, gather documents that share at least one band hash"""
+        return self.query_keys(self.band_keys(signatures))
+
+    def query_keys(self, keys):
         out = set()
-        for (start, end), table in zip(self.bands, self.tables):
-            band_hash = self.band_hash(signatures, start, end)
-            for doc_id in table.get(band_hash, []):
+        for key, table in zip(keys, self.tables):
+            for doc_id in table.get(key, []):
                 out.add(doc_id)
         return out
 
     def add(self, doc_id, signature):
         """Add document to table for each band"""
-        for (start, end), table in zip(self.bands, self.tables):
-            band_hash = self.band_hash(signature, start, end)
-            table[band_hash].append(doc_id)
+        self.add_keys(doc_id, self.band_keys(signature))
+
+    def add_keys(self, doc_id, keys):
+        for key, table in zip(keys, self.tables):
+            table[key].append(doc_id)
+
+    def bucket_sizes(self, keys):
+        """Size of the bucket each band key falls in"""
+        return [len(table.get(key, ())) for key, table in zip(keys, self.tables)]
+
+    def band_keys_many(self, signatures):
+        return np.array([self.band_keys(sig) for sig in signatures], dtype=np.uint64).reshape(-1, len(self.bands))
+
+    def add_many(self, doc_ids, band_keys):
+        """Insert many docs, band_keys = (len(doc_ids), bands) array"""
+        for doc_id, keys in zip(doc_ids, np.asarray(band_keys, dtype=np.uint64).tolist()):
+            self.add_keys(doc_id, keys)
+
+    def query_many(self, band_keys):
+        """Candidate ids (sorted array) of each row of band keys"""
+        return [np.array(sorted(self.query_keys(keys)), dtype=np.int64)
+                for keys in np.asarray(band_keys, dtype=np.uint64).tolist()]
+
+BAND_SALT = np.uint64(0x9E3779B97F4A7C15)
+
+def band_keys_array(signatures, r):
+    """
+    Integer band keys of a (k,) signature or (n, k) signatures, all bands at once -> (..., k // r)
+     - key = mix64 chain over the band's r slots, seeded by the band index, so keys of
+       different bands do not meet in one table
+    """
+    sigs = np.asarray(signatures, dtype=np.uint64)
+    rows = sigs.reshape(*sigs.shape[:-1], -1, r)
+    keys = mix64((np.arange(1, rows.shape[-2] + 1, dtype=np.uint64)) * BAND_SALT)
+    for j in range(r):
+        keys = mix64(keys ^ rows[..., j])
+    return keys
+
+class ArrayLSH:
+    """
+    LSH band tables as key-sorted (CSR-style) runs of flat numpy arrays
+     - band keys come from band_keys_array (arithmetic, salted per band), so every band
+       shares one table: (key, doc id) entries in uint64 / uint32 arrays, 12 bytes each
+     - inserts go to a small delta buffer; a full buffer is sorted into a run and runs of
+       similar size are merged (log-structured), so an insert costs O(log n) amortized
+       however large its bucket
+     - a query is one searchsorted per run (+ dict lookups in the buffer), a bucket is a contiguous slice
+     - add_many / query_many work on (docs, bands) key arrays in one pass
+    Same band_keys / query_keys / add_keys / bucket_sizes interface as LSH, keys differ from LSH's
+    """
+    batched = True
+
+    def __init__(self, k=128, r=4, buffer=1024):
+        assert k % r == 0
+        self.k = k
+        self.r = r
+        self.bands = [(i, i+r) for i in range(0, k, r)]
+        self.runs = [] # [(sorted keys, ids)], sizes decreasing
+        self.buf_keys = np.zeros(buffer, dtype=np.uint64)
+        self.buf_ids = np.zeros(buffer, dtype=np.uint32)
+        self.buf_len = 0
+        self.buf_index = defaultdict(list) # buffered key -> doc ids
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return sum(keys.nbytes + ids.nbytes for keys, ids in self.runs) + self.buf_keys.nbytes + self.buf_ids.nbytes
+
+    def band_keys(self, signature):
+        return band_keys_array(signature, self.r)
+
+    def band_keys_many(self, signatures):
+        return band_keys_array(signatures, self.r)
+
+    def _push(self, keys, ids):
+        """Sort entries into a run, merge with the smaller-or-equal runs before it"""
+        while self.runs and len(self.runs[-1][0]) <= 2 * len(keys):
+            run_keys, run_ids = self.runs.pop()
+            keys, ids = np.concatenate([run_keys, keys]), np.concatenate([run_ids, ids])
+        order = np.argsort(keys, kind="stable")
+        self.runs.append((keys[order], ids[order]))
+
+    def _flush(self):
+        if self.buf_len:
+            self._push(self.buf_keys[:self.buf_len].copy(), self.buf_ids[:self.buf_len].copy())
+            self.buf_len = 0
+            self.buf_index.clear()
+
+    def add_many(self, doc_ids, band_keys):
+        """Insert many docs, band_keys = (len(doc_ids), bands) array"""
+        band_keys = np.asarray(band_keys, dtype=np.uint64)
+        keys = band_keys.reshape(-1)
+        ids = np.repeat(np.asarray(doc_ids, dtype=np.uint32), band_keys.shape[-1])
+        self.size += len(keys)
+        if self.buf_len + len(keys) > len(self.buf_keys):
+            self._flush()
+            if len(keys) > len(self.buf_keys): # bulk load: straight to a run
+                self._push(keys.copy(), ids)
+                return
+        end = self.buf_len + len(keys)
+        self.buf_keys[self.buf_len:end] = keys
+        self.buf_ids[self.buf_len:end] = ids
+        self.buf_len = end
+        for key, doc_id in zip(keys.tolist(), ids.tolist()):
+            self.buf_index[key].append(doc_id)
+
+    def add_keys(self, doc_id, keys):
+        self.add_many([doc_id], np.asarray(keys, dtype=np.uint64)[None])
+
+    def add(self, doc_id, signature):
+        self.add_keys(doc_id, self.band_keys(signature))
+
+    def _probe(self, keys):
+        """(index into keys, doc id) of every entry matching one of keys"""
+        runs, found, ids, sort = self.runs, [], [], None
+        if len(keys) <= 4 * len(self.bands): # few keys: look them up in the buffer's dict
+            for at, key in enumerate(keys.tolist()):
+                hits = self.buf_index.get(key)
+                if hits:
+                    found.append(np.full(len(hits), at))
+                    ids.append(np.array(hits, dtype=np.uint32))
+        else: # many keys: probe them in sorted order (cache friendly), the sorted buffer is one more run
+            sort = np.argsort(keys)
+            keys = keys[sort]
+            if self.buf_len:
+                order = np.argsort(self.buf_keys[:self.buf_len], kind="stable")
+                runs = runs + [(self.buf_keys[order], self.buf_ids[order])]
+        for run_keys, run_ids in runs:
+            lo = run_keys.searchsorted(keys)
+            at = np.flatnonzero(run_keys[np.minimum(lo, len(run_keys) - 1)] == keys)
+            if len(at): # gather the slices [lo, hi) of the keys present
+                lo = lo[at]
+                counts = run_keys.searchsorted(keys[at], side="right") - lo
+                ends = np.cumsum(counts)
+                found.append(np.repeat(at, counts))
+                ids.append(run_ids[np.repeat(lo - ends + counts, counts) + np.arange(int(ends[-1]))])
+        if not found:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint32)
+        found = np.concatenate(found)
+        return (found if sort is None else sort[found]), np.concatenate(ids)
+
+    def query_keys(self, keys):
+        _, ids = self._probe(np.asarray(keys, dtype=np.uint64))
+        return set(ids.tolist())
+
+    def candidates(self, signature):
+        return self.query_keys(self.band_keys(signature))
+
+    def query_many(self, band_keys):
+        """Candidate ids (sorted, deduplicated array) of each row of band keys"""
+        band_keys = np.asarray(band_keys, dtype=np.uint64)
+        num_docs, num_bands = band_keys.shape
+        found, ids = self._probe(band_keys.reshape(-1))
+        codes = np.unique((found // num_bands) << 32 | ids.astype(np.int64)) # sorted by (row, id)
+        rows, ids = codes >> 32, codes & 0xFFFFFFFF
+        bounds = np.searchsorted(rows, np.arange(num_docs + 1))
+        return [ids[bounds[i]:bounds[i + 1]] for i in range(num_docs)]
+
+    def bucket_sizes(self, keys):
+        keys = np.asarray(keys, dtype=np.uint64)
+        found, _ = self._probe(keys)
+        return np.bincount(found, minlength=len(keys)).tolist()
+
+def make_lsh(backend="dict", k=128, r=4):
+    """LSH tables: "dict" (blake2b band keys, dict of lists) or "array" (ArrayLSH)"""
+    if backend == "dict":
+        return LSH(k=k, r=r)
+    if backend == "array":
+        return ArrayLSH(k=k, r=r)
+    raise ValueError(f"unknown LSH backend {backend!r}")
+
+def candidate_pairs(band_keys):
+    """
+    All (i, j), i < j, sharing a key in some band, as a unique (P, 2) array
+     - per band: argsort the keys, each run of equal keys is a bucket
+    """
+    num_docs, num_bands = band_keys.shape
+    codes = [] # pair i * num_docs + j
+    for band in range(num_bands):
+        order = np.argsort(band_keys[:, band], kind="stable")
+        keys = band_keys[order, band]
+        bounds = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+        starts = np.concatenate([[0], bounds])
+        ends = np.concatenate([bounds, [num_docs]])
+        shared = ends - starts > 1 # skip singleton buckets
+        for start, end in zip(starts[shared].tolist(), ends[shared].tolist()):
+            bucket = order[start:end]
+            i, j = np.triu_indices(len(bucket), k=1)
+            codes.append(bucket[i] * num_docs + bucket[j]) # stable sort: ascending ids in a bucket
+    if not codes:
+        return np.zeros((0, 2), dtype=np.int64)
+    codes = np.unique(np.concatenate(codes))
+    return np.stack([codes // num_docs, codes % num_docs], axis=1)
+
+def estimate_margin(tau, k, z):
+    """z standard errors of the k-slot MinHash estimate at J = tau"""
+    return z * (tau * (1 - tau) / k) ** 0.5
+
+def rank_candidates(candidates, signature, kept_signatures):
+    """
+    Candidate ids and MinHash-estimated Jaccard (fraction of agreeing slots),
+    most similar first, ties by id
+    """
+    ids = np.fromiter(sorted(candidates), dtype=np.int64, count=len(candidates))
+    est = (kept_signatures.rows(ids) == signature).mean(axis=1)
+    order = np.argsort(-est, kind="stable")
+    return ids[order].tolist(), est[order].tolist()
+
+def first_match(candidates, signature, kept_signatures, fp, kept_shingles, tau, margin=None, verify=hashed_jaccard,
+                stats=NULL_STATS):
+    """
+    First kept doc that fp duplicates, candidates in rank_candidates order
+     - margin (see estimate_margin): an estimate above tau + margin is a duplicate, one below
+       tau - margin ends the search (so are the rest), in between verify(fp, kept) >= tau decides
+    Returns (match id or None, similarity, pairs verified, 1 if decided on the estimate else 0)
+    """
+    pairs = 0
+    for cand_idx, est in zip(*rank_candidates(candidates, signature, kept_signatures)):
+        if margin is not None and est >= tau + margin: # clear duplicate
+            stats.count("estimate_accept")
+            return cand_idx, est, pairs, 1
+        if margin is not None and est < tau - margin: # clear miss
+            stats.count("estimate_reject")
+            return None, None, pairs, 1
+        pairs += 1
+        sim = verify(fp, kept_shingles[cand_idx])
+        if sim >= tau:
+            stats.count("verify_hit")
+            return cand_idx, sim, pairs, 0
+        stats.count("verify_miss")
+    return None, None, pairs, 0
+
+PROBE_BATCH = 256 # signed docs per BatchProbe in the dedup loops
+
+class BatchProbe:
+    """
+    Tables probed for a batch of signatures at once (band_keys_many + query_many), inserts in one add_many
+     - query(i): table candidates of row i, plus docs kept earlier in the batch sharing a band key with it,
+       the same set a query_keys per doc with an add_keys per keep would give
+     - add(doc_id, i): row i is kept, seen by later rows of the batch, in the tables after flush()
+     - tables without a vectorized query_many (lsh.batched False, the dict LSH) are probed and
+       filled per doc instead
+    """
+    def __init__(self, lsh, signatures):
+        self.lsh = lsh
+        self.keys = lsh.band_keys_many(np.asarray(signatures))
+        self.key_lists = self.keys.tolist()
+        self.found = lsh.query_many(self.keys) if lsh.batched else None
+        self.ids, self.rows = [], [] # kept by this batch
+        self.local = defaultdict(list) # (band, key) -> ids kept by this batch
+
+    def query(self, i):
+        if self.found is None:
+            return self.lsh.query_keys(self.key_lists[i])
+        candidates = set(self.found[i].tolist())
+        if self.ids:
+            for band, key in enumerate(self.key_lists[i]):
+                candidates.update(self.local.get((band, key), ()))
+        return candidates
+
+    def add(self, doc_id, i):
+        if self.found is None:
+            self.lsh.add_keys(doc_id, self.key_lists[i])
+            return
+        self.ids.append(doc_id)
+        self.rows.append(i)
+        for band, key in enumerate(self.key_lists[i]):
+            self.local[band, key].append(doc_id)
+
+    def flush(self):
+        if self.ids:
+            self.lsh.add_many(self.ids, self.keys[self.rows])
 
 # ------------------------------------------------------------ #       
 # Dedup 
 # ------------------------------------------------------------ #
 
-def dedup_lsh(indir, outdir, n=10, type="text", tau=0.5, k=128, r=4, seed=42, length=None):
+def dedup_lsh(indir, outdir, n=10, type="text", tau=0.5, k=128, r=4, seed=42, length=None, workers=1, chunksize=64,
+              index=None, append=False, compact=False, hashing="blake2b", lexer="tokenize", shards=0,
+              confidence=None, signer="minhash", cache=None, cache_bytes=1 << 30,
+              output="txt", stats=None, recall=0.95, memory_budget=None, cascade=False, backend="dict"):
     """
     LSH-MinHash dedup
-     - Build MinHash signature for each file
-     - Generate candidates (prob = 1 - (1-s^r)^b)
+     - Build MinHash signature for each file (workers > 1 = process pool)
+     - Generate candidates (prob = 1 - (1-s^r)^b), accept in order
+     - index = dir to save kept docs to; append = load it first and only sign new files
+       (verification then uses shingle fingerprints)
+     - compact = keep kept shingles as sorted uint64 hashes in one arena,
+       verify by sorted-array intersection instead of set jaccard
+     - hashing = "blake2b" per shingle, or "rolling" polynomial hashes (implies compact,
+       signatures differ from blake2b ones)
+     - lexer = "tokenize" or "regex" code tokenizer (see jaccard.tokenize_code)
+     - shards > 1 = band tables partitioned across shard processes (see shard.ShardedLSH)
+     - candidates are verified in order of MinHash-estimated Jaccard, most similar first
+     - confidence = z, decide on the estimate alone when it is more than z standard errors
+       from tau, verify exactly in between (None = always verify)
+     - signer = "minhash" or "oph" (one-permutation hashing, see OnePermutationHash)
+     - cache = dir of a content-addressed DocCache (see cache.py) holding fingerprints and
+       signatures across runs/methods (implies compact), bounded to cache_bytes
+     - indir = dir of .txt files or of JSONL/Parquet shards (see corpus.list_docs)
+     - output = "txt" files, "manifest" of kept ids, "jsonl" or "parquet" shards (see corpus.write_kept)
+     - stats = instrument.Stats, per-stage timers, candidate/bucket size histograms, verify hit/miss counts
+     - k / r = "auto": planned from a corpus sample for the fastest config whose S-curve at tau
+       reaches recall (see planner.py)
+     - memory_budget = bytes of kept fingerprints held in memory (implies compact), the rest spill to
+       an append-only segment file in TMPDIR read back through an LRU (see store.SpillStore); an index
+       keeps its own arena
+     - cascade = run the checks as cascade.py stages (LSH -> estimate -> exact) with per-stage
+       selectivity (implies compact)
+     - backend = "dict" band tables (LSH) or "array" (ArrayLSH: integer band keys in flat numpy
+       tables, less memory per entry; its band keys differ, an index records the backend;
+       not with shards > 1), either way probed PROBE_BATCH docs at a time (see BatchProbe)
     """
     indir, outdir = Path(indir), Path(outdir)
     outdir.mkdir(parents=True, exist_ok=True)
+    stats = stats if stats is not None else NULL_STATS
 
+    files = list_docs(indir, length) # largest first
+    if "auto" in (k, r):
+        from methods.planner import resolve # planner builds on lsh
+        k, r = resolve(files, tau, dict(k=k, r=r), recall, index, append, n=n, type=type, seed=seed, signer=signer,
+                       compact=compact or index is not None or cache is not None or memory_budget is not None,
+                       hashing=hashing, lexer=lexer, workers=workers).values()
 
-    norm_data = normalize_text if type == "text" else normalize_code
-    
-    minhash = MinHash(k=k, seed=seed)
-    lsh = LSH(k=k, r=r)
-
-    files = sorted(indir.glob("*.txt"), key=lambda x: x.stat().st_size, reverse=True) # largest files first
-    if length:
-        files = files[:length]
+    minhash = make_signer(signer, k=k, seed=seed)
+    if shards > 1 and backend != "dict":
+        raise ValueError(f"shards > 1 uses dict band tables, backend={backend!r} is not supported")
+    if shards > 1:
+        from methods.shard import ShardedLSH # shard builds on LSH
+        lsh = ShardedLSH.local(k=k, r=r, shards=shards)
+    else:
+        lsh = make_lsh(backend, k=k, r=r)
     
     kept_paths = []
     kept_shingles = []
+    kept_signatures = SignatureArray(k)
+    verify = jaccard
+    margin = estimate_margin(tau, k, confidence) if confidence is not None else None
     total_candidates = 0
     total_pairs = 0
+    total_estimated = 0 # decided on the estimate alone
 
-    for path in files: 
-        text = path.read_text()
-        text = norm_data(text)
-        tokens = tokenize_text(text) if type == "text" else tokenize_code(text)
-        sh = ngram_char_shingling(text, n) if type == "text" else ngram_token_shingling(tokens, n)
-        sig = minhash.signature_from_iter(sh)
+    doc_cache = None
+    if cache is not None:
+        from methods.cache import DocCache
+        doc_cache = DocCache(cache, max_bytes=cache_bytes)
 
-        # Query LSH among previous kept docs
-        candidates = lsh.candidates(sig)
-        total_candidates += len(candidates)
-        
-        keep = True
-        if candidates:
-            for cand_idx in candidates:
-                total_pairs += 1
-                if jaccard(sh, kept_shingles[cand_idx]) >= tau:
-                    keep = False
-                    break
-        
-        if keep:
-            lsh.add(len(kept_paths), sig) # add signature to LSH
-            kept_shingles.append(sh)
-            kept_paths.append(path)
-        else:
-            #print(f"Duplicate found: {path.name}")
-            continue
+    spill = None
+    if compact or index is not None or hashing == "rolling" or doc_cache is not None or memory_budget is not None or cascade:
+        compact = True
+        kept_shingles = ShingleArena()
+        verify = hashed_jaccard
+        if memory_budget is not None and index is None:
+            kept_shingles = spill = SpillStore(memory_budget)
+
+    store = None
+    if index is not None:
+        meta = dict(method="lsh", n=n, type=type, k=k, r=r, seed=seed, hashing=hashing, lexer=lexer, signer=signer)
+        if backend != "dict": # dict-backend indexes predate the option
+            meta["backend"] = backend
+        store = Index.open(index, meta, append=append)
+        store.fill(lsh)
+        seen = set(store.ids)
+        files = [path for path in files if path.name not in seen] # only sign new files
+        kept_shingles = store.shingles
+        kept_signatures = SignatureArray(k, store.loaded.get("signatures"))
+
+    if cascade:
+        from methods.cascade import Probe, lsh_cascade # cascade builds on lsh
+        casc = lsh_cascade(lsh, minhash, kept_shingles, tau, margin, store)
+        signed = sign_files(files, n, type, (minhash,), workers=workers, chunksize=chunksize, compact=compact, hashing=hashing, lexer=lexer, cache=doc_cache, stats=stats)
+        start = len(kept_shingles)
+        kept_paths = casc.run(files, (Probe(sh, sig=sig) for sh, (sig,) in signed), kept_shingles, stats)
+        if store is not None:
+            casc.kept.fill_index(store, [path.name for path in kept_paths], start)
+        report = casc.report()
+        total_candidates, total_pairs, total_estimated = report["lsh"]["out"], casc.stages[-1].checked, casc.stages[1].decided
+        print(casc.describe())
+    else:
+        signed = sign_files(files, n, type, (minhash,), workers=workers, chunksize=chunksize, compact=compact, hashing=hashing, lexer=lexer, cache=doc_cache, stats=stats)
+        signed = zip(files, signed)
+        while batch := list(islice(signed, PROBE_BATCH)):
+            with stats.time("query"):
+                probe = BatchProbe(lsh, [sig for _, (_, (sig,)) in batch])
+            for i, (path, (sh, (sig,))) in enumerate(batch):
+                stats.tick()
+                # Query LSH among previous kept docs
+                with stats.time("query"):
+                    keys = probe.keys[i]
+                    candidates = probe.query(i)
+                total_candidates += len(candidates)
+                if stats.enabled:
+                    stats.observe("candidates", len(candidates))
+                    if hasattr(lsh, "bucket_sizes"):
+                        for size in lsh.bucket_sizes(keys):
+                            stats.observe("bucket", size)
+
+                keep = True
+                if candidates:
+                    with stats.time("verify"):
+                        match, _, pairs, estimated = first_match(candidates, sig, kept_signatures, sh, kept_shingles,
+                                                                 tau, margin, verify, stats)
+                    keep = match is None
+                    total_pairs += pairs
+                    total_estimated += estimated
+
+                if keep:
+                    with stats.time("insert"):
+                        probe.add(len(kept_shingles), i) # add signature to LSH at the end of the batch
+                        kept_signatures.append(sig)
+                        if store is not None:
+                            store.add(path.name, sig, keys)
+                        kept_shingles.append(sh)
+                    kept_paths.append(path)
+            with stats.time("insert"):
+                probe.flush()
     
     print(f"{len(kept_paths)} unique files out of {len(files)} total files")
-    print(f"Total candidates: {total_candidates}, Total pairs checked: {total_pairs}")
+    print(f"Total candidates: {total_candidates}, Total pairs checked: {total_pairs}, Decided on estimate: {total_estimated}")
+
+    if shards > 1:
+        lsh.close()
+    if spill is not None:
+        spill.report(stats)
+        spill.close()
+    if doc_cache is not None:
+        doc_cache.evict()
+    if store is not None:
+        store.save(index)
     
-    for path in kept_paths:
-        (outdir / path.name).write_text(path.read_text())
+    with stats.time("write"):
+        write_kept(kept_paths, outdir, output)
     
     return {
         "unique_count": len(kept_paths),
         "total_files": len(files),
         "candidates": total_candidates,
-        "pairs_checked": total_pairs
+        "pairs_checked": total_pairs,
+        "estimated": total_estimated,
     }
     
    
@@ -0,0 +1,127 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from methods.jaccard import (
+    shingle, normalize_text, normalize_code, tokenize_code,
+    ngram_char_shingling, ngram_token_shingling,
+)
+from methods.hashing import hash_shingles, fingerprint, shingle_hashes
+from methods.instrument import Stats, NULL_STATS
+
+# ------------------------------------------------------------ #
+# Per-document stage: read -> normalize -> tokenize -> shingle -> sign
+# ------------------------------------------------------------ #
+
+_worker = {} # per-process config, set once by the pool initializer
+
+def _init(n, type, signers, compact, hashing, lexer, cache, timed=False):
+    _worker.update(n=n, type=type, signers=signers, compact=compact, hashing=hashing, lexer=lexer, cache=cache,
+                   timed=timed)
+
+def timed_shingle(text, n, type, lexer, stats):
+    """jaccard.shingle with normalize / tokenize / shingle timed as separate stages"""
+    if type == "text":
+        with stats.time("normalize"):
+            text = normalize_text(text)
+        with stats.time("shingle"):
+            return ngram_char_shingling(text, n)
+    with stats.time("normalize"):
+        text = normalize_code(text)
+    with stats.time("tokenize"):
+        tokens = tokenize_code(text, lexer)
+    with stats.time("shingle"):
+        return ngram_token_shingling(tokens, n)
+
+def sign_doc(path, n, type, signers, compact=False, hashing="blake2b", lexer="tokenize", cache=None, stats=None):
+    """
+    Shingle a file (Path or corpus.Doc) and sign it with each signer, returns (shingles, signatures)
+    Shingles are hashed once and shared by all signers
+     - compact = return the fingerprint (sorted uint64 hashes) instead of the set
+     - hashing = "rolling": rolling hashes straight from the text, always compact
+     - lexer = code tokenizer, see jaccard.tokenize_code
+     - cache = cache.DocCache, fingerprint and signatures looked up by content (always compact)
+     - stats = instrument.Stats, times read / normalize / tokenize / shingle / hash / sign (or cache / sign)
+    """
+    if stats is not None and stats.enabled:
+        return _sign_timed(path, n, type, signers, compact, hashing, lexer, cache, stats)
+    if cache is not None:
+        base, xs = cache.shingles(path, n, type, hashing, lexer)
+        return xs, tuple(cache.signature(base, s, xs) for s in signers)
+    text = path.read_text()
+    if hashing == "rolling":
+        xs = shingle_hashes(text, n, type, lexer)
+        return xs, tuple(s.signature_from_hashes(xs) for s in signers)
+    sh = shingle(text, n, type, lexer)
+    xs = fingerprint(sh) if compact else hash_shingles(sh)
+    return (xs if compact else sh), tuple(s.signature_from_hashes(xs) for s in signers)
+
+def _sign_timed(path, n, type, signers, compact, hashing, lexer, cache, stats):
+    """sign_doc, one timer per stage (same results)"""
+    if cache is not None:
+        with stats.time("cache"):
+            base, xs = cache.shingles(path, n, type, hashing, lexer)
+        with stats.time("sign"):
+            return xs, tuple(cache.signature(base, s, xs) for s in signers)
+    with stats.time("read"):
+        text = path.read_text()
+    if hashing == "rolling":
+        with stats.time("shingle"): # normalize + tokenize + rolling hash in one pass
+            xs = out = shingle_hashes(text, n, type, lexer)
+    else:
+        sh = timed_shingle(text, n, type, lexer, stats)
+        with stats.time("hash"):
+            xs = fingerprint(sh) if compact else hash_shingles(sh)
+        out = xs if compact else sh
+    with stats.time("sign"):
+        return out, tuple(s.signature_from_hashes(xs) for s in signers)
+
+def _sign(path):
+    stats = Stats() if _worker["timed"] else None
+    out = sign_doc(path, _worker["n"], _worker["type"], _worker["signers"],
+                   _worker["compact"], _worker["hashing"], _worker["lexer"], _worker["cache"], stats)
+    if stats is None:
+        return out
+    return out, {stage: (ns, stats.calls[stage]) for stage, ns in stats.timers.items()}
+
+def _sign_chunk(paths):
+    return [_sign(path) for path in paths]
+
+def sign_files(files, n=10, type="text", signers=(), workers=1, chunksize=64, compact=False,
+               hashing="blake2b", lexer="tokenize", cache=None, stats=None, inflight=2):
+    """
+    Yield (shingles, signatures) for each file, in input order
+     - workers > 1 fans out to a process pool in contiguous chunks of files,
+       so size-sorted input gives size-sorted chunks
+     - results come back in order, so the sequential accept loop is unchanged
+     - at most inflight chunks per worker are submitted ahead of the consumer, so a slow accept
+       loop holds a bounded window of results, not the whole corpus
+     - stats = instrument.Stats, worker stage timers are sent back with each result and summed
+    """
+    stats = stats if stats is not None else NULL_STATS
+    if workers <= 1:
+        for path in files:
+            yield sign_doc(path, n, type, signers, compact, hashing, lexer, cache, stats)
+        return
+
+    initargs = (n, type, signers, compact, hashing, lexer, cache, stats.enabled)
+    files = iter(files)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=initargs) as ex:
+        pending = deque()
+
+        def submit():
+            chunk = list(islice(files, chunksize))
+            if chunk:
+                pending.append(ex.submit(_sign_chunk, chunk))
+
+        for _ in range(inflight * workers):
+            submit()
+        while pending:
+            results = pending.popleft().result()
+            submit() # refill the window before handing results out
+            if not stats.enabled:
+                yield from results
+                continue
+            for out, timers in results:
+                stats.merge_timers(timers)
+                yield out
@@ -0,0 +1,240 @@
+import json
+import math
+import random
+import time
+from pathlib import Path
+
+import numpy as np
+
+from methods.jaccard import jaccard
+from methods.hashing import fingerprint
+from methods.store import hashed_jaccard
+from methods.lsh import LSH, make_signer
+from methods.simhash import SimHash, popcount64
+from methods.pipeline import sign_files
+from methods.corpus import list_docs
+
+# ------------------------------------------------------------ #
+# Parameter planner: S-curve recall + sampled candidate rate +
+# costs measured on this machine -> cheapest (k, r[, t])
+# ------------------------------------------------------------ #
+
+KS = tuple(range(32, 513, 16))
+RS = tuple(range(1, 17))
+TS = tuple(range(0, 33))
+DEFAULTS = dict(k=128, r=4, t=3) # dedup_lsh / dedup_sim defaults, used when there is nothing to sample
+
+def s_curve(s, r, b):
+    """Probability that a pair of Jaccard s shares at least one of b bands of r rows"""
+    return 1 - (1 - np.asarray(s, dtype=float) ** r) ** b
+
+def _seconds(fn, items):
+    t0 = time.perf_counter()
+    out = [fn(x) for x in items]
+    return time.perf_counter() - t0, out
+
+def _index_seconds(sigs, k, r):
+    """Per-doc band_keys + query + insert time of an LSH(k, r) over the signatures"""
+    lsh = LSH(k=k, r=r)
+    t0 = time.perf_counter()
+    for doc_id, sig in enumerate(sigs):
+        keys = lsh.band_keys(sig)
+        lsh.query_keys(keys)
+        lsh.add_keys(doc_id, keys)
+    return (time.perf_counter() - t0) / len(sigs)
+
+def profile(files, n=10, type="text", tau=0.5, k=512, seed=42, signer="minhash", sample=1000, pairs=500000,
+            compact=False, hashing="blake2b", lexer="tokenize", workers=1, simhash=False):
+    """
+    Sign a random sample of the corpus once and measure what the cost model needs
+     - matches = histogram of agreeing slots (out of k) over sampled doc pairs, gives the
+       candidate rate of any (k' <= k, r) through the S-curve
+     - near = sampled pairs with exact Jaccard >= tau (and SimHash codes of all pairs if simhash)
+     - seconds per doc: shingle, sign = sign_fixed + sign_per_k * k, LSH = row * k + band * bands,
+       seconds per verified pair
+    """
+    rand = random.Random(seed)
+    docs = rand.sample(list(files), min(sample, len(files)))
+    m = len(docs)
+    if m < 2:
+        raise ValueError(f"profile needs at least 2 docs to sample, got {m}")
+    compact = compact or hashing == "rolling"
+
+    t0 = time.perf_counter()
+    signed = list(sign_files(docs, n, type, (), workers=workers, compact=compact, hashing=hashing, lexer=lexer))
+    shingle_s = (time.perf_counter() - t0) / m # wall time, already split across workers
+    shingles = [sh for sh, _ in signed]
+    xs = shingles if compact else [fingerprint(sh) for sh in shingles]
+
+    # signing is linear in k: fit it from two sizes
+    k_lo = max(k // 4, 8)
+    lo_s, _ = _seconds(make_signer(signer, k=k_lo, seed=seed).signature_from_hashes, xs)
+    hi_s, sigs = _seconds(make_signer(signer, k=k, seed=seed).signature_from_hashes, xs)
+    sign_per_k = max(hi_s - lo_s, 0.0) / (k - k_lo) / m
+    sign_fixed = max(lo_s / m - sign_per_k * k_lo, 0.0)
+    sigs = np.array(sigs, dtype=np.uint64)
+
+    # sampled pairs: all of them if few enough
+    if m * (m - 1) // 2 <= pairs:
+        pi, pj = np.triu_indices(m, k=1)
+    else:
+        rng = np.random.default_rng(seed)
+        pi, pj = rng.integers(0, m, pairs), rng.integers(0, m, pairs)
+        pi, pj = pi[pi != pj], pj[pi != pj]
+    matches = np.concatenate([(sigs[pi[s:s + 4096]] == sigs[pj[s:s + 4096]]).sum(axis=1)
+                              for s in range(0, len(pi), 4096)] or [np.zeros(0, dtype=np.int64)])
+
+    # exact Jaccard of pairs whose estimate could reach tau
+    close = np.flatnonzero(matches / k >= tau - 4 * math.sqrt(tau * (1 - tau) / k))
+    exact = np.array([hashed_jaccard(xs[pi[c]], xs[pj[c]]) for c in close.tolist()])
+    near = close[exact >= tau] if len(close) else close
+
+    # LSH cost per doc = row * k + band * bands, from r = 1 (k bands) and r = k (one band)
+    sub = sigs[:200]
+    one_band = _index_seconds(sub, k, k)
+    all_bands = _index_seconds(sub, k, 1)
+    band = max(all_bands - one_band, 0.0) / (k - 1)
+    row = max(one_band - band, 0.0) / k
+
+    # exact verify cost on random sampled pairs
+    verify = hashed_jaccard if compact else jaccard
+    vp = list(zip(pi[:1000].tolist(), pj[:1000].tolist()))
+    verify_s, _ = _seconds(lambda p: verify(shingles[p[0]], shingles[p[1]]), vp)
+
+    prof = dict(docs=m, k=k, pairs=len(pi), matches=np.bincount(matches, minlength=k + 1),
+                pair_matches=matches, near=near, workers=workers,
+                shingle=shingle_s, sign_fixed=sign_fixed, sign_per_k=sign_per_k,
+                row=row, band=band, verify=verify_s / max(len(vp), 1))
+    if simhash:
+        sim_s, codes = _seconds(SimHash(bits=64).signature_from_hashes, xs)
+        codes = np.array(codes, dtype=np.uint64)
+        prof.update(simhash=sim_s / m, xor=codes[pi] ^ codes[pj])
+    return prof
+
+def candidate_rate(matches, r, b):
+    """Fraction of sampled pairs LSH(r rows x b bands) makes candidates, from the agreeing-slot histogram"""
+    k = len(matches) - 1
+    total = matches.sum()
+    return float((matches * s_curve(np.arange(k + 1) / k, r, b)).sum() / total) if total else 0.0
+
+def sim_gate(xor, t, sim_index="blocks"):
+    """Which sampled pairs (code xor) pass the SimHash gate of dedup_sim at Hamming threshold t"""
+    if sim_index == "sorted":
+        return popcount64(xor) <= t
+    num_blocks = t + 1
+    val, rem = divmod(64, num_blocks)
+    passed = np.zeros(len(xor), dtype=bool)
+    shift = 0
+    for i in range(num_blocks): # same low-to-high blocks as simhash.split_blocks
+        w = val + (1 if i < rem else 0)
+        passed |= (xor >> np.uint64(shift)) & np.uint64((1 << w) - 1) == 0
+        shift += w
+    return passed
+
+def _options(prof, total, tau, ks, rs, gates):
+    """(recall floor, seconds, params) of every (k, r[, t]), gates = [(t, gate recall, pair mask)]"""
+    pairs = total * (total - 1) / 2
+    workers = max(prof["workers"], 1)
+    for k in ks:
+        if k > prof["k"]:
+            continue
+        for r in rs:
+            if k % r:
+                continue
+            b = k // r
+            floor = float(s_curve(tau, r, b))
+            per_doc = (prof["shingle"] + (prof["sign_fixed"] + prof["sign_per_k"] * k) / workers
+                       + prof["row"] * k + prof["band"] * b)
+            for t, gate_recall, mask in gates:
+                if mask is None:
+                    rate, gate_s = candidate_rate(prof["matches"], r, b), 0.0
+                else: # candidates = passed the gate and shared a band
+                    hist = np.bincount(prof["pair_matches"][mask], minlength=prof["k"] + 1)
+                    rate, gate_s = candidate_rate(hist, r, b) * float(mask.mean()), prof["simhash"] / workers
+                seconds = float(total * (per_doc + gate_s) + rate * pairs * prof["verify"])
+                params = dict(k=k, r=r) if t is None else dict(k=k, r=r, t=t)
+                yield dict(params, recall=floor * gate_recall, lsh_recall=floor, candidate_rate=rate,
+                           seconds=seconds)
+
+def _choose(options, recall):
+    """Fastest option meeting recall, else the highest-recall one (met=False)"""
+    options = list(options)
+    if not options:
+        raise ValueError("no feasible parameters, check ks / rs / ts")
+    feasible = [o for o in options if o["recall"] >= recall]
+    best = min(feasible, key=lambda o: o["seconds"]) if feasible else max(options, key=lambda o: (o["recall"], -o["seconds"]))
+    ranked = sorted(feasible or options, key=lambda o: o["seconds"])[:5]
+    return dict(best, met=bool(feasible), options=ranked)
+
+def plan_lsh(files, tau, recall=0.95, n=10, type="text", ks=KS, rs=RS, prof=None, **kwargs):
+    """
+    Fastest (k, r) for dedup_lsh whose S-curve at tau reaches recall
+     - files = corpus docs (see corpus.list_docs), sampled for the profile
+     - recall floor = 1 - (1 - tau^r)^(k/r): every pair at J >= tau is a candidate with at least this prob
+     - seconds = docs * (shingle + sign(k) + LSH(k, b)) + candidate rate * pairs * verify
+     - kwargs go to profile (sample, seed, signer, compact, hashing, lexer, workers)
+    Returns dict(k, r, recall, candidate_rate, seconds, met, options = top 5)
+    """
+    if prof is None:
+        prof = profile(files, n, type, tau, k=max(ks), **kwargs)
+    return _choose(_options(prof, len(files), tau, ks, rs, [(None, 1.0, None)]), recall)
+
+def plan_sim(files, tau, recall=0.95, n=10, type="text", ks=KS, rs=RS, ts=TS, sim_index="blocks", min_near=10,
+             default_t=7, prof=None, **kwargs):
+    """
+    Fastest (k, r, t) for dedup_sim, recall = LSH recall floor x SimHash gate recall
+     - gate recall = fraction of sampled near pairs (exact J >= tau) passing the gate at t,
+       needs min_near such pairs in the sample, else t = default_t (or the only t in ts)
+     - candidate rate = sampled pairs passing the gate and the LSH S-curve
+    """
+    if prof is None:
+        prof = profile(files, n, type, tau, k=max(ks), simhash=True, **kwargs)
+    near = prof["near"]
+    if len(near) < min_near:
+        ts = [default_t] if default_t in ts else list(ts)[:1]
+    gates = []
+    for t in ts:
+        mask = sim_gate(prof["xor"], t, sim_index)
+        gates.append((t, float(mask[near].mean()) if len(near) >= min_near else 1.0, mask))
+    return _choose(_options(prof, len(files), tau, ks, rs, gates), recall)
+
+def stored_params(index, append):
+    """Params of an index that append will load (they must not be re-planned)"""
+    meta = Path(index) / "meta.json" if index is not None else None
+    return json.loads(meta.read_text()) if append and meta is not None and meta.exists() else None
+
+def resolve(files, tau, params, recall=0.95, index=None, append=False, sim_index=None, **kwargs):
+    """
+    Fill the "auto" entries of params (k, r, and t for dedup_sim) from a plan,
+    fixed entries restrict the search; an index that append will load keeps its params,
+    fewer than 2 files get the DEFAULTS
+    """
+    if "auto" not in params.values():
+        return params
+    stored = stored_params(index, append)
+    if stored is not None:
+        return {key: stored[key] for key in params}
+    if len(files) < 2: # no pairs to plan from
+        out = {key: DEFAULTS[key] if value == "auto" else value for key, value in params.items()}
+        if params["k"] == "auto":
+            out["k"] -= out["k"] % out["r"] # fixed r must divide k
+        return out
+    fixed = {f"{key}s": (value,) for key, value in params.items() if value != "auto"}
+    if "t" in params:
+        plan = plan_sim(files, tau, recall, sim_index=sim_index, **fixed, **kwargs)
+    else:
+        plan = plan_lsh(files, tau, recall, **fixed, **kwargs)
+    print(describe(plan))
+    return {key: plan[key] for key in params}
+
+def describe(plan):
+    params = ", ".join(f"{key}={plan[key]}" for key in ("k", "r", "t") if key in plan)
+    met = "" if plan["met"] else " (recall target not met)"
+    return (f"Planned {params}: recall >= {plan['recall']:.3f}{met}, "
+            f"candidate rate {plan['candidate_rate']:.2e}, est. {plan['seconds']:.1f}s")
+
+if __name__ == "__main__":
+    files = list_docs("data/exact/wiki", 10000)
+    print(describe(plan_lsh(files, tau=0.30, n=4, type="text")))
+    files = list_docs("data/exact/code", 10000)
+    print(describe(plan_sim(files, tau=0.45, n=5, type="code")))
@@ -0,0 +1,476 @@
+import argparse
+import http.client
+import json
+import os
+import queue
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+
+from methods.jaccard import shingle
+from methods.hashing import fingerprint, shingle_hashes
+from methods.store import hashed_jaccard, SignatureArray
+from methods.lsh import make_lsh, make_signer, estimate_margin, first_match
+from methods.simhash import SimHash, SimHashBlock
+from methods.index import Index
+from methods.instrument import Stats
+from methods.corpus import list_docs
+
+# ------------------------------------------------------------ #
+# Resident near-duplicate lookup: one in-memory index, queries
+# micro-batched so a batch is signed in one vectorized call
+# ------------------------------------------------------------ #
+
+class DedupService:
+    """
+    Kept-doc index answering "is this a near-duplicate of anything kept?"
+     - same accept rule as dedup_lsh (t=None) / dedup_sim (t = SimHash gate), verified on fingerprints
+     - check(docs, insert): docs = [(id, text)], insert = bool or one bool per doc,
+       a doc is inserted only if it is not a duplicate (of kept docs or earlier docs of the batch),
+       the whole batch is decided before the index changes, so a batch that raises inserts nothing
+     - index = dir of a persistent Index (see index.py), loaded if it exists, written by snapshot();
+       an index written by dedup_lsh / dedup_sim with the same params can be served
+     - backend = "dict" or "array" LSH tables (see lsh.ArrayLSH), a batch is queried in one query_many
+       call and its inserts go in one add_many call
+    Not thread-safe: serve() runs every call on one batcher thread
+    """
+    def __init__(self, n=10, type="text", tau=0.5, k=128, r=4, seed=42, t=None, hashing="blake2b",
+                 lexer="tokenize", signer="minhash", confidence=None, index=None, stats=None, backend="dict"):
+        self.n, self.type, self.tau, self.hashing, self.lexer = n, type, tau, hashing, lexer
+        self.minhash = make_signer(signer, k=k, seed=seed)
+        self.lsh = make_lsh(backend, k=k, r=r)
+        self.simhash = SimHash(bits=64) if t is not None else None
+        self.blocks = SimHashBlock(t=t) if t is not None else None
+        self.margin = estimate_margin(tau, k, confidence) if confidence is not None else None
+        self.stats = stats if stats is not None else Stats()
+
+        if t is None:
+            meta = dict(method="lsh", n=n, type=type, k=k, r=r, seed=seed, hashing=hashing, lexer=lexer, signer=signer)
+        else:
+            meta = dict(method="sim", n=n, type=type, t=t, k=k, r=r, seed=seed, hashing=hashing, lexer=lexer, signer=signer)
+        if backend != "dict":
+            meta["backend"] = backend
+        self.path = index
+        self.store = Index.open(index, meta, append=True) if index is not None else Index(meta)
+        self.store.fill(self.lsh, self.blocks)
+        self.kept_signatures = SignatureArray(k, self.store.loaded.get("signatures"))
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.store)
+
+    def fingerprint(self, text):
+        if self.hashing == "rolling":
+            return shingle_hashes(text, self.n, self.type, self.lexer)
+        return fingerprint(shingle(text, self.n, self.type, self.lexer))
+
+    def check(self, docs, insert=False):
+        """Returns one {"id", "duplicate", "match", "similarity", "inserted"} per doc"""
+        if not docs:
+            return []
+        inserts = insert if isinstance(insert, (list, tuple)) else [insert] * len(docs)
+        stats, kept = self.stats, self.store.shingles
+        with stats.time("shingle"):
+            fps = [self.fingerprint(text) for _, text in docs]
+        with stats.time("sign"): # one vectorized call per batch
+            sigs = self.minhash.signatures_from_hashes(fps)
+            codes = self.simhash.signatures_from_hashes(fps).tolist() if self.simhash is not None else None
+
+        with stats.time("query"): # kept docs: one bulk probe per batch
+            band_keys = self.lsh.band_keys_many(sigs)
+            found = self.lsh.query_many(band_keys)
+
+        # decide every doc first, against kept docs and docs this batch would insert before it (pending),
+        # the index is only changed once the whole batch went through
+        pending, pending_sigs, pending_fps = [], SignatureArray(sigs.shape[1]), [] # pending[j] = batch position
+        pending_blocks = SimHashBlock(t=self.blocks.t) if codes is not None else None
+        decisions = []
+        for i, ((doc_id, _), fp, sig) in enumerate(zip(docs, fps, sigs)):
+            keys = band_keys[i]
+            with stats.time("query"):
+                candidates = set(found[i].tolist())
+                local = {j for j, p in enumerate(pending) if (band_keys[p] == keys).any()}
+                if codes is not None:
+                    candidates &= self.blocks.candidates(codes[i])
+                    local &= pending_blocks.candidates(codes[i])
+            stats.observe("candidates", len(candidates) + len(local))
+
+            match = similarity = None
+            with stats.time("verify"):
+                if candidates:
+                    cand, similarity, _, _ = first_match(candidates, sig, self.kept_signatures, fp, kept, self.tau,
+                                                         self.margin, hashed_jaccard, stats)
+                    match = self.store.ids[cand] if cand is not None else None
+                if match is None and local:
+                    cand, similarity, _, _ = first_match(local, sig, pending_sigs, fp, pending_fps, self.tau,
+                                                         self.margin, hashed_jaccard, stats)
+                    match = docs[pending[cand]][0] if cand is not None else None
+
+            inserted = match is None and inserts[i]
+            if inserted:
+                if codes is not None:
+                    pending_blocks.add(len(pending), codes[i])
+                pending.append(i)
+                pending_sigs.append(sig)
+                pending_fps.append(fp)
+            decisions.append((doc_id, match, similarity, inserted))
+
+        if pending:
+            with stats.time("insert"):
+                start = len(kept)
+                for i in pending:
+                    if codes is not None:
+                        self.blocks.add(len(kept), codes[i])
+                    self.kept_signatures.append(sigs[i])
+                    self.store.add(docs[i][0], sigs[i], band_keys[i], codes[i] if codes is not None else None)
+                    kept.append(fps[i])
+                self.lsh.add_many(range(start, len(kept)), band_keys[pending])
+            self.dirty = True
+
+        results = []
+        for doc_id, match, similarity, inserted in decisions:
+            stats.count("duplicate" if match is not None else "unique")
+            results.append({"id": doc_id, "duplicate": match is not None, "match": match,
+                            "similarity": similarity, "inserted": inserted})
+        stats.tick(len(docs))
+        return results
+
+    def snapshot(self):
+        """Write the index (atomic per file, see Index.save), no-op without a path or changes"""
+        if self.path is None or not self.dirty:
+            return False
+        with self.stats.time("snapshot"):
+            self.store.save(self.path)
+        self.dirty = False
+        return True
+
+class _Request:
+    __slots__ = ("docs", "insert", "done", "results", "error")
+
+    def __init__(self, docs, insert):
+        self.docs, self.insert = docs, insert # docs None = snapshot
+        self.done = threading.Event()
+        self.results = self.error = None
+
+class Batcher:
+    """
+    One thread owning the service: waits for a request, then gathers more for up to
+    max_wait seconds or max_batch docs and answers them with one check() call
+     - snapshots the index every snapshot_every seconds (between batches) and on close
+     - keeps the last `window` request latencies for p50/p99
+    """
+    def __init__(self, service, max_batch=64, max_wait=0.002, snapshot_every=60.0, window=100000):
+        self.service = service
+        self.max_batch, self.max_wait, self.snapshot_every = max_batch, max_wait, snapshot_every
+        self.queue = queue.Queue()
+        self.latencies = deque(maxlen=window)
+        self.batches = self.batched_docs = self.requests = 0
+        self.last_snapshot = time.monotonic()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="dedup-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, docs, insert=False):
+        """Blocking call from a handler thread, returns the per-doc results"""
+        t0 = time.perf_counter()
+        req = _Request(docs, insert)
+        self.queue.put(req)
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        self.latencies.append(time.perf_counter() - t0) # deque append is atomic
+        return req.results
+
+    def _run(self):
+        while not self.closed:
+            try:
+                batch = [self.queue.get(timeout=0.1)]
+            except queue.Empty:
+                self._maybe_snapshot()
+                continue
+            size = len(batch[0].docs or ())
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    req = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(req)
+                size += len(req.docs or ())
+            self._process(batch)
+            self._maybe_snapshot()
+
+    def _process(self, batch):
+        checks = [req for req in batch if req.docs is not None]
+        self.requests += len(checks)
+        try:
+            if checks:
+                docs = [doc for req in checks for doc in req.docs]
+                inserts = [req.insert for req in checks for _ in req.docs]
+                results = self.service.check(docs, inserts)
+                start = 0
+                for req in checks:
+                    req.results = results[start:start + len(req.docs)]
+                    start += len(req.docs)
+                self.batches += 1
+                self.batched_docs += len(docs)
+            for req in batch:
+                if req.docs is None:
+                    req.results = self.service.snapshot()
+        except Exception as e: # fail the whole batch, check() left the index as it was
+            for req in batch:
+                req.error = e
+        for req in batch:
+            req.done.set()
+
+    def _maybe_snapshot(self):
+        if time.monotonic() - self.last_snapshot >= self.snapshot_every:
+            self.service.snapshot()
+            self.last_snapshot = time.monotonic()
+
+    def report(self):
+        lat = np.array(self.latencies) * 1000
+        return {
+            "kept": len(self.service),
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch": self.batched_docs / self.batches if self.batches else 0.0,
+            "p50_ms": float(np.percentile(lat, 50)) if len(lat) else None,
+            "p99_ms": float(np.percentile(lat, 99)) if len(lat) else None,
+            **self.service.stats.to_json(),
+        }
+
+    def close(self):
+        self.closed = True
+        self.thread.join()
+        self.service.snapshot()
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    POST /check  {"docs": [{"id", "text"}]} (or one {"id", "text"}) -> {"results": [...]}
+    POST /insert same, check-and-insert
+    POST /snapshot, GET /stats (JSON, p50/p99), GET /metrics (Prometheus)
+    """
+    protocol_version = "HTTP/1.1" # keep-alive
+
+    def _send(self, code, body, content_type="application/json"):
+        data = body.encode("utf-8") if isinstance(body, str) else json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        batcher = self.server.batcher
+        if self.path == "/stats":
+            self._send(200, batcher.report())
+        elif self.path == "/metrics":
+            self._send(200, batcher.service.stats.to_prometheus(), "text/plain; version=0.0.4")
+        else:
+            self._send(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)) or 0)
+        try:
+            if self.path == "/snapshot":
+                return self._send(200, {"saved": self.server.batcher.submit(None)})
+            if self.path not in ("/check", "/insert"):
+                return self._send(404, {"error": f"unknown path {self.path}"})
+            req = json.loads(body)
+            docs = req["docs"] if "docs" in req else [req]
+            docs = [(str(doc["id"]), doc["text"]) for doc in docs]
+            results = self.server.batcher.submit(docs, insert=self.path == "/insert")
+            self._send(200, {"results": results})
+        except (ValueError, KeyError, TypeError) as e:
+            self._send(400, {"error": repr(e)})
+        except Exception as e:
+            self._send(500, {"error": repr(e)})
+
+    def log_message(self, format, *args): # no per-request logging
+        pass
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer on a Unix domain socket path"""
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = "localhost", 0
+
+def serve(service, address, background=False, **batcher_kwargs):
+    """
+    Serve over HTTP/1.1 on address = Unix socket path (str) or (host, port) on localhost
+     - batcher_kwargs = max_batch, max_wait, snapshot_every (see Batcher)
+     - background = run in a daemon thread and return the server (server.shutdown() + close())
+    """
+    server = UnixHTTPServer(address, _Handler) if isinstance(address, str) else ThreadingHTTPServer(address, _Handler)
+    server.daemon_threads = True
+    server.batcher = Batcher(service, **batcher_kwargs)
+    if background:
+        threading.Thread(target=server.serve_forever, name="dedup-server", daemon=True).start()
+        return server
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close(server)
+
+def close(server):
+    """Stop serving, final snapshot"""
+    server.shutdown()
+    server.server_close()
+    server.batcher.close()
+    if isinstance(server.server_address, str) and os.path.exists(server.server_address):
+        os.unlink(server.server_address)
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+class Client:
+    """Keep-alive client of serve(), one per thread"""
+    def __init__(self, address, timeout=60):
+        if isinstance(address, str):
+            self.conn = _UnixConnection(address, timeout)
+        else:
+            self.conn = http.client.HTTPConnection(*address, timeout=timeout)
+
+    def _call(self, method, path, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        headers = {"Content-Type": "application/json"} if data is not None else {}
+        self.conn.request(method, path, body=data, headers=headers)
+        resp = self.conn.getresponse()
+        payload = resp.read()
+        if resp.status != 200:
+            raise RuntimeError(f"{method} {path}: {resp.status} {payload.decode('utf-8', 'replace')}")
+        return payload.decode("utf-8") if path == "/metrics" else json.loads(payload)
+
+    def check(self, docs):
+        """docs = [(id, text)], returns per-doc results"""
+        return self._call("POST", "/check", {"docs": [{"id": i, "text": text} for i, text in docs]})["results"]
+
+    def insert(self, docs):
+        """Check-and-insert"""
+        return self._call("POST", "/insert", {"docs": [{"id": i, "text": text} for i, text in docs]})["results"]
+
+    def snapshot(self):
+        return self._call("POST", "/snapshot")["saved"]
+
+    def stats(self):
+        return self._call("GET", "/stats")
+
+    def metrics(self):
+        return self._call("GET", "/metrics")
+
+    def close(self):
+        self.conn.close()
+
+def load_test(address, docs, concurrency=8, per_request=1, insert=True):
+    """
+    Send docs = [(id, text)] from `concurrency` client threads, per_request docs per call
+    Returns client-side throughput and p50/p99 latency, plus the server's /stats
+    """
+    requests = [docs[i:i + per_request] for i in range(0, len(docs), per_request)]
+    latencies, duplicates = [], []
+    lock = threading.Lock()
+    it = iter(requests)
+
+    def worker():
+        client = Client(address)
+        lat, dup = [], 0
+        while True:
+            with lock:
+                req = next(it, None)
+            if req is None:
+                break
+            t0 = time.perf_counter()
+            results = client.insert(req) if insert else client.check(req)
+            lat.append(time.perf_counter() - t0)
+            dup += sum(res["duplicate"] for res in results)
+        client.close()
+        with lock:
+            latencies.extend(lat)
+            duplicates.append(dup)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    elapsed = time.perf_counter() - t0
+
+    lat = np.array(latencies) * 1000
+    client = Client(address)
+    server = client.stats()
+    client.close()
+    return {
+        "docs": len(docs), "requests": len(requests), "concurrency": concurrency, "seconds": elapsed,
+        "docs_per_sec": len(docs) / elapsed, "duplicates": sum(duplicates),
+        "p50_ms": float(np.percentile(lat, 50)), "p99_ms": float(np.percentile(lat, 99)),
+        "server": {key: server[key] for key in ("kept", "batches", "mean_batch", "p50_ms", "p99_ms")},
+    }
+
+def _address(args):
+    return args.socket if args.socket else (args.host, args.port)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resident near-duplicate lookup service")
+    parser.add_argument("mode", choices=["serve", "bench"], help="bench = load test (starts a local server unless --connect)")
+    parser.add_argument("--socket", help="Unix socket path (default: localhost HTTP)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--index", help="Index dir, loaded if present, snapshotted to")
+    parser.add_argument("--n", type=int, default=4)
+    parser.add_argument("--type", default="text", choices=["text", "code"])
+    parser.add_argument("--tau", type=float, default=0.30)
+    parser.add_argument("--k", type=int, default=336)
+    parser.add_argument("--r", type=int, default=3)
+    parser.add_argument("--t", type=int, help="SimHash gate (dedup_sim rule), default none (dedup_lsh rule)")
+    parser.add_argument("--backend", default="dict", choices=["dict", "array"], help="LSH tables")
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-wait", type=float, default=0.002, help="seconds to gather a batch")
+    parser.add_argument("--snapshot-every", type=float, default=60.0)
+    parser.add_argument("--indir", default="data/exact/wiki", help="bench: corpus to send")
+    parser.add_argument("--length", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--per-request", type=int, default=1)
+    parser.add_argument("--check-only", action="store_true", help="bench: check instead of check-and-insert")
+    parser.add_argument("--connect", action="store_true", help="bench: use a running server")
+    args = parser.parse_args()
+
+    params = dict(n=args.n, type=args.type, tau=args.tau, k=args.k, r=args.r, t=args.t, index=args.index, backend=args.backend)
+    if args.mode == "serve":
+        serve(DedupService(**params), _address(args), max_batch=args.max_batch, max_wait=args.max_wait,
+              snapshot_every=args.snapshot_every)
+    else:
+        docs = [(doc.name, doc.read_text()) for doc in list_docs(args.indir, args.length)]
+        address = _address(args)
+        server = None
+        if not args.connect:
+            address = args.socket or str(Path(tempfile.mkdtemp()) / "dedup.sock")
+            server = serve(DedupService(**params), address, background=True, max_batch=args.max_batch,
+                           max_wait=args.max_wait, snapshot_every=args.snapshot_every)
+        print(json.dumps(load_test(address, docs, args.concurrency, args.per_request, not args.check_only), indent=1))
+        if server is not None:
+            close(server)
@@ -0,0 +1,151 @@
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from methods.lsh import LSH, candidate_pairs
+
+# ------------------------------------------------------------ #
+# Band-partitioned LSH: each shard owns the tables of a band range
+# Shards speak plain messages over multiprocessing Connections, so
+# local pipes and remote sockets (Listener/Client) look the same
+# ------------------------------------------------------------ #
+
+def serve(conn):
+    """
+    Shard loop, owns the tables of its bands
+     - ("init", r, num_bands)
+     - ("add", doc_id, keys) / ("add_many", doc_ids, keys)
+     - ("query", keys) -> set of doc ids / ("query_many", keys) -> sorted id array per row
+     - ("pairs", keys) -> (P, 2) candidate pairs within these bands (map step)
+     - ("close",)
+    """
+    lsh = None
+    while True:
+        msg = conn.recv()
+        op = msg[0]
+        if op == "init":
+            _, r, num_bands = msg
+            lsh = LSH(k=r * num_bands, r=r)
+        elif op == "add":
+            lsh.add_keys(msg[1], msg[2])
+        elif op == "add_many":
+            for doc_id, keys in zip(msg[1], msg[2]):
+                lsh.add_keys(doc_id, keys)
+        elif op == "query":
+            conn.send(lsh.query_keys(msg[1]))
+        elif op == "query_many":
+            conn.send(lsh.query_many(msg[1]))
+        elif op == "pairs":
+            conn.send(candidate_pairs(msg[1]))
+        elif op == "close":
+            conn.close()
+            return
+
+def listen(address, authkey=None):
+    """Serve one remote shard at address, e.g. ("0.0.0.0", 6000)"""
+    with Listener(address, authkey=authkey) as listener:
+        serve(listener.accept())
+
+class ShardedLSH:
+    """
+    LSH with bands partitioned across shards
+     - band keys are computed here and routed to the shard owning each band
+     - queries fan out to every shard, candidate sets are merged here
+     - pairs() is a map-reduce: shards group their band columns, pairs are merged here
+    Same add/candidates/band_keys/query_keys/add_keys/band_keys_many/query_many/add_many interface as LSH
+    """
+    batched = True # query_many is one round trip per shard
+    def __init__(self, k=128, r=4, conns=()):
+        self.lsh = LSH(k=k, r=r) # band layout + band_hash, tables stay empty
+        self.k, self.r, self.bands = k, r, self.lsh.bands
+        self.conns = list(conns)
+        self.parts = [part.tolist() for part in np.array_split(np.arange(len(self.bands)), len(self.conns))]
+        self.procs = []
+        for conn, part in zip(self.conns, self.parts):
+            conn.send(("init", r, len(part)))
+
+    @classmethod
+    def local(cls, k=128, r=4, shards=2):
+        """Run each shard in a local process connected by a pipe"""
+        conns, procs = [], []
+        for _ in range(shards):
+            parent, child = Pipe()
+            proc = Process(target=serve, args=(child,), daemon=True)
+            proc.start()
+            child.close()
+            conns.append(parent)
+            procs.append(proc)
+        sharded = cls(k=k, r=r, conns=conns)
+        sharded.procs = procs
+        return sharded
+
+    @classmethod
+    def connect(cls, addresses, k=128, r=4, authkey=None):
+        """Use shards already listening at addresses (see listen)"""
+        return cls(k=k, r=r, conns=[Client(address, authkey=authkey) for address in addresses])
+
+    def band_keys(self, signature):
+        return self.lsh.band_keys(signature)
+
+    def _route(self, keys):
+        return [[keys[band] for band in part] for part in self.parts]
+
+    def candidates(self, signature):
+        return self.query_keys(self.band_keys(signature))
+
+    def query_keys(self, keys):
+        for conn, part_keys in zip(self.conns, self._route(keys)):
+            conn.send(("query", part_keys))
+        out = set()
+        for conn in self.conns:
+            out |= conn.recv()
+        return out
+
+    def band_keys_many(self, signatures):
+        return self.lsh.band_keys_many(signatures)
+
+    def query_many(self, band_keys):
+        """Candidate ids (sorted array) of each row of band keys, one round trip per shard"""
+        band_keys = np.asarray(band_keys, dtype=np.uint64)
+        for conn, part in zip(self.conns, self.parts):
+            conn.send(("query_many", band_keys[:, part].tolist()))
+        found = [conn.recv() for conn in self.conns]
+        return [np.unique(np.concatenate(rows)) for rows in zip(*found)]
+
+    def add(self, doc_id, signature):
+        self.add_keys(doc_id, self.band_keys(signature))
+
+    def add_keys(self, doc_id, keys):
+        for conn, part_keys in zip(self.conns, self._route(keys)):
+            conn.send(("add", doc_id, part_keys))
+
+    def add_many(self, doc_ids, band_keys):
+        """Insert many docs, band_keys = (len(doc_ids), bands) array"""
+        band_keys = np.asarray(band_keys, dtype=np.uint64)
+        for conn, part in zip(self.conns, self.parts):
+            conn.send(("add_many", list(doc_ids), band_keys[:, part].tolist()))
+
+    def pairs(self, band_keys):
+        """Candidate pairs of all docs, band_keys = (N, bands) array"""
+        band_keys = np.asarray(band_keys, dtype=np.uint64)
+        for conn, part in zip(self.conns, self.parts): # map
+            conn.send(("pairs", np.ascontiguousarray(band_keys[:, part])))
+        found = [conn.recv() for conn in self.conns]
+        num_docs = len(band_keys) # reduce
+        codes = np.unique(np.concatenate([p[:, 0] * num_docs + p[:, 1] for p in found]))
+        return np.stack([codes // num_docs, codes % num_docs], axis=1)
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(("close",))
+            conn.close()
+        for proc in self.procs:
+            proc.join()
+        self.conns, self.procs = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -5,6 +5,10 @@ import io
 import hashlib
 import random
 from collections import defaultdict
+from itertools import combinations, islice
+from math import comb
+
+import numpy as np
 
 from methods.jaccard import (
     normalize_text, normalize_code,
@@ -12,28 +16,77 @@ from methods.jaccard import (
     ngram_char_shingling, ngram_token_shingling,
     jaccard
 )
-from methods.lsh import hash64, encode_shingle, MinHash, LSH
+from methods.lsh import hash_shingles, make_lsh, make_signer, estimate_margin, first_match, BatchProbe, PROBE_BATCH
+from methods.store import hashed_jaccard, ShingleArena, SignatureArray, SpillStore
+from methods.pipeline import sign_files
+from methods.index import Index
+from methods.corpus import list_docs, write_kept
+from methods.instrument import NULL_STATS
 
 def hamming_distance(a, b):
     return bin(a ^ b).bit_count()
 
 class SimHash:
-    def __init__(self, bits=64):
+    """
+    64-bit SimHash, bit i = sign of the (weighted) vote of bit i over shingle hashes
+    Vectorized: hashes unpacked to a (chunk x 64) bit matrix, votes summed per column
+    """
+    def __init__(self, bits=64, chunk=4096):
         assert bits == 64
         self.bits = bits
-        
-    def signature_from_iter(self, it):
-        acc = [0] * self.bits
-        for shingle in it:
-            h = hash64(encode_shingle(shingle))
-            for i in range(self.bits): # bitwise voting
-                acc[i] += 1 if ((h >> i) & 1) else -1
-
-        out = 0
-        for i in range(self.bits):
-            if acc[i] >= 0: # positive vote
-                out |= (1 << i)
-        return out
+        self.chunk = chunk # max shingles per bit matrix
+
+    def _bits(self, xs):
+        """(len(xs), 64) 0/1 matrix, column i = bit i"""
+        b = np.ascontiguousarray(xs, dtype="<u8").view(np.uint8).reshape(-1, 8)
+        return np.unpackbits(b, axis=1, bitorder="little")
+
+    def _pack(self, votes):
+        """(n, 64) bool -> (n,) uint64 codes"""
+        return np.packbits(votes, axis=1, bitorder="little").view("<u8").ravel().astype(np.uint64)
+
+    def signature_from_iter(self, it, weights=None):
+        return self.signature_from_hashes(hash_shingles(it), weights)
+
+    def signature_from_hashes(self, xs, weights=None):
+        """
+        SimHash code of one document of shingle hashes, as int
+         - weights = optional per-shingle weights (e.g. IDF), aligned with xs
+        """
+        return int(self.signatures_from_hashes([xs], None if weights is None else [weights])[0])
+
+    def signatures_from_hashes(self, docs, weights=None):
+        """
+        Batch codes for many documents of shingle hashes, returns (len(docs),) uint64
+         - docs are packed into one array, votes reduced per document with reduceat
+         - unweighted: +1/-1 votes, ties set the bit
+        """
+        lens = np.array([len(xs) for xs in docs], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lens)])
+        xs = np.concatenate([np.asarray(x, dtype=np.uint64) for x in docs]) if len(docs) else np.zeros(0, dtype=np.uint64)
+        if weights is None:
+            ones = np.zeros((len(docs), self.bits), dtype=np.int64) # votes for 1 per bit
+            total = lens
+        else:
+            w = np.concatenate([np.asarray(x, dtype=np.float64) for x in weights]) if len(docs) else np.zeros(0)
+            ones = np.zeros((len(docs), self.bits), dtype=np.float64)
+            total = np.bincount(np.repeat(np.arange(len(docs)), lens), weights=w, minlength=len(docs)) # empty docs: 0
+
+        for start in range(0, len(xs), self.chunk):
+            end = min(start + self.chunk, len(xs))
+            bits = self._bits(xs[start:end])
+            if weights is not None:
+                bits = bits * w[start:end, None]
+            starts = np.unique(np.clip(offsets[:-1], start, end))
+            starts = starts[starts < end]
+            rows = np.searchsorted(offsets, starts, side="right") - 1 # last doc starting there (skips empty docs)
+            ones[rows] += np.add.reduceat(bits, starts - start, axis=0, dtype=ones.dtype)
+
+        return self._pack(2 * ones >= total[:, None]) # vote = ones - (total - ones) >= 0
+
+    def signatures_from_iters(self, its, weights=None):
+        """Batch codes for many documents of shingles"""
+        return self.signatures_from_hashes([hash_shingles(it) for it in its], weights)
 
 def split_blocks(code, num_blocks, bits):
     """Split code into num_blocks blocks, remainder for earlier blocks"""
@@ -84,84 +137,315 @@ class SimHashBlock:
                 out.add(doc_id)
         return out
 
-def dedup_sim(indir, outdir, n=10, type="text", tau=0.5, t=3, k=128, r=4, seed=42, length=None):
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def popcount64(x):
+    """Set bits of each uint64, np.bitwise_count if available (numpy >= 2)"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    return _POPCOUNT8[np.ascontiguousarray(x).view(np.uint8).reshape(-1, 8)].sum(axis=1)
+
+def block_widths(num_blocks, bits=64):
+    """Widths of the blocks split_blocks cuts, low bits first"""
+    val, rem = divmod(bits, num_blocks)
+    return [val + (1 if i < rem else 0) for i in range(num_blocks)]
+
+TABLE_BITS = 6 # high bits of a SimHashIndex key holding the table number
+PREFIX_BITS = 64 - TABLE_BITS
+RUN_GROWTH = 8 # a SimHashIndex run absorbs the ones after it up to this size ratio
+
+class SimHashIndex:
+    """
+    Sorted-permutation SimHash index (Manku et al.), Hamming distance <= t exactly
+
+    Codes are cut into B > t blocks: a code within distance t differs in at most t blocks,
+    so it matches the query on at least B - t of them. One table per choice of B - t blocks
+    (C(B, t) tables), keyed by those blocks' bits (the prefix of that permutation):
+     - B is the smallest with a prefix of >= log2(n) bits in every table and <= max_tables
+       tables, re-picked (tables rebuilt) as n grows
+     - all tables share one key space, key = table number << PREFIX_BITS | prefix, kept in
+       key-sorted runs merged log-structured (as in lsh.ArrayLSH); a probe is one searchsorted
+       per run for every table's exact prefix, the hits are filtered by vectorized popcount
+     - below brute_max codes, or if no B narrows a table below n / tables codes (large t, e.g. 16),
+       a probe is a brute-force popcount over every code instead
+     - new codes go to a small fixed buffer (popcount-scanned), sorted into a run when full
+    """
+    def __init__(self, t, buffer=1024, max_tables=63, brute_max=1 << 14):
+        assert 0 <= t < 64 and t + 1 <= max_tables < 1 << TABLE_BITS # key + 1 stays in 64 bits
+        self.t = t
+        self.buffer = buffer
+        self.max_tables = max_tables
+        self.brute_max = brute_max
+        self.codes = SignatureArray(1, capacity=buffer)
+        self.doc_ids = SignatureArray(1, capacity=buffer)
+        self.merged = 0 # the first merged codes are in the tables, the rest is the buffer
+        self.num_blocks = None # None = no tables, brute force
+        self.tables = 0
+        self.runs = [] # [(sorted table keys, code of each key)], sizes decreasing
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        runs = sum(keys.nbytes + pos.nbytes for keys, pos in self.runs)
+        return runs + self.codes.data.nbytes + self.doc_ids.data.nbytes
+
+    def layout(self, n):
+        """Number of blocks B for n codes, None if a brute-force scan is cheaper"""
+        if n < self.brute_max:
+            return None
+        target = int(n - 1).bit_length()
+        best = None
+        for num_blocks in range(self.t + 1, 65):
+            tables = comb(num_blocks, self.t)
+            if tables > self.max_tables:
+                break
+            prefix = sum(sorted(block_widths(num_blocks))[:num_blocks - self.t]) # narrowest table
+            best = (num_blocks, tables, prefix)
+            if prefix >= target:
+                break
+        num_blocks, tables, prefix = best
+        return num_blocks if 1 << min(prefix, PREFIX_BITS) > tables else None
+
+    def _build(self, num_blocks):
+        """Per table (shift, mask, out shift) of each prefix block, padded with mask 0"""
+        widths = block_widths(num_blocks)
+        shifts = np.cumsum([0] + widths[:-1]).tolist()
+        chosen = list(combinations(range(num_blocks - 1, -1, -1), num_blocks - self.t))
+        self.tables = len(chosen)
+        self.shifts = np.zeros((self.tables, num_blocks - self.t, 1), dtype=np.uint64)
+        self.masks, self.outs = np.zeros_like(self.shifts), np.zeros_like(self.shifts)
+        self.drops = np.zeros((self.tables, 1), dtype=np.uint64)
+        for table, blocks in enumerate(chosen):
+            out = sum(widths[b] for b in blocks)
+            self.drops[table] = max(0, out - PREFIX_BITS) # keep the top PREFIX_BITS
+            for j, b in enumerate(blocks):
+                out -= widths[b]
+                self.shifts[table, j], self.masks[table, j], self.outs[table, j] = shifts[b], (1 << widths[b]) - 1, out
+        self.tags = (np.arange(self.tables, dtype=np.uint64) << np.uint64(PREFIX_BITS))[:, None]
+
+    def _table_keys(self, codes):
+        """(tables, len(codes)) keys of codes (uint64 array)"""
+        parts = ((codes >> self.shifts) & self.masks) << self.outs
+        return (np.bitwise_or.reduce(parts, axis=1) >> self.drops) | self.tags
+
+    def add(self, doc_id, code):
+        self.codes.append(code)
+        self.doc_ids.append(doc_id)
+        if len(self.codes) - self.merged >= self.buffer:
+            self.merge()
+
+    def merge(self):
+        """Sort the buffer into a run, rebuild the tables if n calls for another layout"""
+        num_blocks = self.layout(len(self.codes))
+        if num_blocks != self.num_blocks:
+            self.num_blocks, self.merged, self.tables, self.runs = num_blocks, 0, 0, []
+            if num_blocks is not None:
+                self._build(num_blocks)
+        if num_blocks is None or self.merged == len(self.codes):
+            self.merged = len(self.codes)
+            return
+        pos = np.arange(self.merged, len(self.codes), dtype=np.uint32)
+        keys, pos = self._table_keys(self.codes.data[pos, 0]).reshape(-1), np.tile(pos, self.tables)
+        while self.runs and len(self.runs[-1][0]) <= RUN_GROWTH * len(keys): # few, geometrically growing runs
+            run_keys, run_pos = self.runs.pop()
+            keys, pos = np.concatenate([run_keys, keys]), np.concatenate([run_pos, pos])
+        order = np.argsort(keys, kind="stable")
+        self.runs.append((keys[order], pos[order]))
+        self.merged = len(self.codes)
+
+    def candidates(self, code):
+        target = np.uint64(code)
+        n = len(self.codes)
+        codes, doc_ids = self.codes.data[:n, 0], self.doc_ids.data[:n, 0]
+        if self.num_blocks is None: # brute force
+            return set(doc_ids[popcount64(codes ^ target) <= self.t].tolist())
+        keys = self._table_keys(np.array([code], dtype=np.uint64)).reshape(-1)
+        bounds = np.concatenate([keys, keys + np.uint64(1)]) # [start, end) of each table's prefix
+        hits = [np.arange(self.merged, n)] # buffer
+        for run_keys, run_pos in self.runs:
+            found = np.searchsorted(run_keys, bounds)
+            start, lens = found[:self.tables], found[self.tables:] - found[:self.tables]
+            total = int(lens.sum())
+            if total:
+                hits.append(run_pos[np.arange(total) + np.repeat(start - np.cumsum(lens) + lens, lens)])
+        hits = np.concatenate(hits)
+        return set(doc_ids[hits[popcount64(codes[hits] ^ target) <= self.t]].tolist())
+
+def dedup_sim(indir, outdir, n=10, type="text", tau=0.5, t=3, k=128, r=4, seed=42, length=None, workers=1, chunksize=64,
+              index=None, append=False, compact=False, hashing="blake2b", lexer="tokenize", confidence=None,
+              sim_index="blocks", signer="minhash", cache=None, cache_bytes=1 << 30,
+              output="txt", stats=None, recall=0.95, memory_budget=None, cascade=False, backend="dict"):
     """
     Hierarchical SimHash + MinHash/LSH.
-     - Build SimHash and MinHash signatures for each file
+     - Build SimHash and MinHash signatures for each file (workers > 1 = process pool)
      - Gate with SimHash blocks (m=t+1), intersect with LSH candidates
+     - sim_index = "blocks" (any block equal) or "sorted" (SimHashIndex, Hamming <= t only,
+       a stricter gate: use a larger t, e.g. 16 for text at tau=0.3)
+     - index = dir to save kept docs to; append = load it first and only sign new files
+       (verification then uses shingle fingerprints)
+     - compact = keep kept shingles as sorted uint64 hashes in one arena,
+       verify by sorted-array intersection instead of set jaccard
+     - hashing = "blake2b" per shingle, or "rolling" polynomial hashes (implies compact,
+       signatures differ from blake2b ones)
+     - lexer = "tokenize" or "regex" code tokenizer (see jaccard.tokenize_code)
+     - candidates are verified in order of MinHash-estimated Jaccard, most similar first
+     - confidence = z, decide on the estimate alone when it is more than z standard errors
+       from tau, verify exactly in between (None = always verify)
+     - signer = "minhash" or "oph" (one-permutation hashing, see lsh.OnePermutationHash)
+     - cache = dir of a content-addressed DocCache (see cache.py) holding fingerprints and
+       signatures across runs/methods (implies compact), bounded to cache_bytes
+     - indir = dir of .txt files or of JSONL/Parquet shards (see corpus.list_docs)
+     - output = "txt" files, "manifest" of kept ids, "jsonl" or "parquet" shards (see corpus.write_kept)
+     - stats = instrument.Stats, per-stage timers, candidate/bucket size histograms, verify hit/miss counts
+     - k / r / t = "auto": planned from a corpus sample for the fastest config whose LSH recall
+       floor x sampled SimHash gate recall reaches recall (see planner.py)
+     - memory_budget = bytes of kept fingerprints held in memory (implies compact), the rest spill to
+       an append-only segment file in TMPDIR read back through an LRU (see store.SpillStore); an index
+       keeps its own arena
+     - cascade = staged filter (see cascade.py): SimHash -> shared band -> estimate -> exact, each
+       on what the previous let through; with workers <= 1 MinHash is only computed for docs with
+       SimHash candidates and for kept docs once they become candidates (implies compact)
+     - backend = "dict" or "array" LSH band tables (see dedup_lsh)
     """
     indir, outdir = Path(indir), Path(outdir)
+    stats = stats if stats is not None else NULL_STATS
     outdir.mkdir(parents=True, exist_ok=True)
 
-    norm_data = normalize_text if type == "text" else normalize_code
-    
+    files = list_docs(indir, length) # largest first
+    if "auto" in (k, r, t):
+        from methods.planner import resolve # planner builds on simhash
+        k, r, t = resolve(files, tau, dict(k=k, r=r, t=t), recall, index, append, sim_index=sim_index, n=n, type=type,
+                          seed=seed, signer=signer, hashing=hashing, lexer=lexer, workers=workers,
+                          compact=compact or index is not None or cache is not None or memory_budget is not None).values()
+
     simhash = SimHash(bits=64)
-    blocks = SimHashBlock(t=t)
+    blocks = SimHashIndex(t=t) if sim_index == "sorted" else SimHashBlock(t=t)
 
-    minhash = MinHash(k=k, seed=seed)
-    lsh = LSH(k=k, r=r)
+    minhash = make_signer(signer, k=k, seed=seed)
+    lsh = make_lsh(backend, k=k, r=r)
     
-
-    files = sorted(indir.glob("*.txt"), key=lambda x: x.stat().st_size, reverse=True) # largest files first
-    if length:
-        files = files[:length]
     
     kept_paths = []
     kept_shingles = []
+    kept_signatures = SignatureArray(k)
+    verify = jaccard
+    margin = estimate_margin(tau, k, confidence) if confidence is not None else None
+
+    doc_cache = None
+    if cache is not None:
+        from methods.cache import DocCache
+        doc_cache = DocCache(cache, max_bytes=cache_bytes)
+
+    spill = None
+    if compact or index is not None or hashing == "rolling" or doc_cache is not None or memory_budget is not None or cascade:
+        compact = True
+        kept_shingles = ShingleArena()
+        verify = hashed_jaccard
+        if memory_budget is not None and index is None:
+            kept_shingles = spill = SpillStore(memory_budget)
+
+    store = None
+    if index is not None:
+        meta = dict(method="sim", n=n, type=type, t=t, k=k, r=r, seed=seed, hashing=hashing, lexer=lexer, signer=signer)
+        if backend != "dict": # dict-backend indexes predate the option
+            meta["backend"] = backend
+        store = Index.open(index, meta, append=append)
+        store.fill(lsh, blocks)
+        seen = set(store.ids)
+        files = [path for path in files if path.name not in seen] # only sign new files
+        kept_shingles = store.shingles
+        kept_signatures = SignatureArray(k, store.loaded.get("signatures"))
 
     total_sim_candidates = 0 # candidates from SimHash blocks
     total_candidates = 0 # candidates from LSH
     total_pairs = 0 # exact Jaccard checks
+    total_estimated = 0 # decided on the estimate alone
     
-    for path in files:
-        text = path.read_text()
-        text = norm_data(text)
-        tokens = tokenize_text(text) if type == "text" else tokenize_code(text)
-        sh = ngram_char_shingling(text, n) if type == "text" else ngram_token_shingling(tokens, n)
-        
-        # SimHash
-        code = simhash.signature_from_iter(sh)
-        sim_cands = blocks.candidates(code)
-        total_sim_candidates += len(sim_cands)
-        
-        # MinHash
-        sig = minhash.signature_from_iter(sh)
-        lsh_cands = lsh.candidates(sig)
-        
-        # Take intersection
-        candidates = sim_cands & lsh_cands
-        total_candidates += len(candidates)
-        
-        keep = True
-        if candidates:
-            for cand_idx in candidates:
-                total_pairs += 1
-                if jaccard(sh, kept_shingles[cand_idx]) >= tau:
-                    keep = False
-                    break
-        
-        if keep:
-            blocks.add(len(kept_paths), code) # add code to SimHash blocks
-            lsh.add(len(kept_paths), sig) # add signature to LSH
-            kept_shingles.append(sh)
-            kept_paths.append(path)
-        else:
-            #print(f"Duplicate found: {path.name}")
-            continue
+    if cascade:
+        from methods.cascade import Probe, sim_cascade # cascade builds on simhash
+        lazy = workers <= 1 # with a pool, MinHash is cheaper signed eagerly in the workers
+        casc = sim_cascade(blocks, lsh, minhash, kept_shingles, tau, margin, store)
+        signed = sign_files(files, n, type, (simhash,) if lazy else (simhash, minhash), workers=workers, chunksize=chunksize, compact=compact, hashing=hashing, lexer=lexer, cache=doc_cache, stats=stats)
+        start = len(kept_shingles)
+        kept_paths = casc.run(files, (Probe(sh, *sigs) for sh, sigs in signed), kept_shingles, stats)
+        if store is not None:
+            casc.kept.fill_index(store, [path.name for path in kept_paths], start)
+        report = casc.report()
+        total_sim_candidates, total_candidates = report["simhash"]["out"], report["lsh"]["out"]
+        total_pairs, total_estimated = casc.stages[-1].checked, casc.stages[2].decided
+        print(casc.describe())
+    else:
+        signed = sign_files(files, n, type, (simhash, minhash), workers=workers, chunksize=chunksize, compact=compact, hashing=hashing, lexer=lexer, cache=doc_cache, stats=stats)
+        signed = zip(files, signed)
+        while batch := list(islice(signed, PROBE_BATCH)):
+            with stats.time("query"):
+                probe = BatchProbe(lsh, [sig for _, (_, (_, sig)) in batch])
+            for i, (path, (sh, (code, sig))) in enumerate(batch):
+                stats.tick()
+                # SimHash
+                with stats.time("simhash_query"):
+                    sim_cands = blocks.candidates(code)
+                total_sim_candidates += len(sim_cands)
+
+                # MinHash
+                with stats.time("query"):
+                    keys = probe.keys[i]
+                    lsh_cands = probe.query(i)
+
+                # Take intersection
+                candidates = sim_cands & lsh_cands
+                total_candidates += len(candidates)
+                if stats.enabled:
+                    stats.observe("sim_candidates", len(sim_cands))
+                    stats.observe("candidates", len(candidates))
+                    for size in lsh.bucket_sizes(keys):
+                        stats.observe("bucket", size)
+
+                keep = True
+                if candidates:
+                    with stats.time("verify"):
+                        match, _, pairs, estimated = first_match(candidates, sig, kept_signatures, sh, kept_shingles,
+                                                                 tau, margin, verify, stats)
+                    keep = match is None
+                    total_pairs += pairs
+                    total_estimated += estimated
+
+                if keep:
+                    with stats.time("insert"):
+                        blocks.add(len(kept_shingles), code) # add code to SimHash blocks
+                        probe.add(len(kept_shingles), i) # add signature to LSH at the end of the batch
+                        kept_signatures.append(sig)
+                        if store is not None:
+                            store.add(path.name, sig, keys, code)
+                        kept_shingles.append(sh)
+                    kept_paths.append(path)
+            with stats.time("insert"):
+                probe.flush()
     
     print(f"{len(kept_paths)} unique files out of {len(files)} total files")
     print(f"SimHash candidates: {total_sim_candidates}")
-    print(f"Total candidates (intersection): {total_candidates}, Total pairs checked: {total_pairs}")
+    print(f"Total candidates (intersection): {total_candidates}, Total pairs checked: {total_pairs}, Decided on estimate: {total_estimated}")
+
+    if spill is not None:
+        spill.report(stats)
+        spill.close()
+    if doc_cache is not None:
+        doc_cache.evict()
+    if store is not None:
+        store.save(index)
     
-    for path in kept_paths:
-        (outdir / path.name).write_text(path.read_text())
+    with stats.time("write"):
+        write_kept(kept_paths, outdir, output)
     
     return {
         "unique_count": len(kept_paths),
         "total_files": len(files),
         "simhash_candidates": total_sim_candidates,
         "candidates": total_candidates,
-        "pairs_checked": total_pairs
+        "pairs_checked": total_pairs,
+        "estimated": total_estimated,
     }
     
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+def hashed_jaccard(a, b):
+    """
+    Jaccard on sorted unique uint64 fingerprints
+    Intersection count = binary search of the smaller array in the larger
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    if len(a) == 0:
+        return 0.0
+    idx = np.searchsorted(b, a)
+    idx[idx == len(b)] = 0
+    inter = int(np.count_nonzero(b[idx] == a))
+    return inter / (len(a) + len(b) - inter)
+
+class ShingleArena:
+    """
+    Kept shingle fingerprints packed into one contiguous uint64 arena + offsets
+     - append-only, the arena grows by doubling
+     - arena/offsets of a previous run (e.g. memory-mapped) are read in place
+    """
+    def __init__(self, arena=None, offsets=None, capacity=1 << 16):
+        self.base_arena = np.zeros(0, dtype=np.uint64) if arena is None else arena
+        self.base_offsets = np.zeros(1, dtype=np.int64) if offsets is None else offsets
+        self.base = len(self.base_offsets) - 1 # num of docs read in place
+        self.data = np.empty(capacity, dtype=np.uint64)
+        self.offsets = [0]
+
+    def __len__(self):
+        return self.base + len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if idx < self.base:
+            return self.base_arena[self.base_offsets[idx]:self.base_offsets[idx + 1]]
+        idx -= self.base
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def append(self, fp):
+        start = self.offsets[-1]
+        end = start + len(fp)
+        if end > len(self.data):
+            data = np.empty(max(end, 2 * len(self.data)), dtype=np.uint64)
+            data[:start] = self.data[:start]
+            self.data = data
+        self.data[start:end] = fp
+        self.offsets.append(end)
+
+    @property
+    def nbytes(self):
+        return self.base_arena.nbytes + self.offsets[-1] * 8 + len(self) * 8
+
+    def flat(self):
+        """Return (arena, offsets) covering all docs"""
+        offsets = np.asarray(self.offsets[1:], dtype=np.int64) + self.base_offsets[-1]
+        arena = np.concatenate([self.base_arena, self.data[:self.offsets[-1]]])
+        return arena, np.concatenate([self.base_offsets, offsets])
+
+class SpillStore:
+    """
+    Kept shingle fingerprints under a memory budget
+     - every fingerprint is appended to one segment file on disk (offsets stay in memory)
+     - reads go through an LRU of resident fingerprints, evicted down to budget bytes,
+       misses are read back with pread
+     - hits / misses / bytes_read / evictions for reporting
+    Same interface as ShingleArena for the dedup loops: len, [idx], append
+    """
+    def __init__(self, budget, path=None):
+        self.budget = budget
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="spill-", suffix=".seg")
+            os.close(fd)
+        self.path = str(path)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_APPEND)
+        self.offsets = [0] # byte offsets into the segment
+        self.resident = OrderedDict() # idx -> fingerprint, least recently used first
+        self.resident_bytes = 0
+        self.hits = self.misses = self.bytes_read = self.evictions = 0
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        fp = self.resident.get(idx)
+        if fp is not None:
+            self.resident.move_to_end(idx)
+            self.hits += 1
+            return fp
+        self.misses += 1
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        fp = np.frombuffer(os.pread(self.fd, end - start, start), dtype=np.uint64)
+        self.bytes_read += end - start
+        self._keep(idx, fp)
+        return fp
+
+    def append(self, fp):
+        fp = np.ascontiguousarray(fp, dtype=np.uint64)
+        os.write(self.fd, fp.tobytes())
+        self.offsets.append(self.offsets[-1] + fp.nbytes)
+        self._keep(len(self) - 1, fp) # just kept docs are likely candidates soon
+
+    def _keep(self, idx, fp):
+        self.resident[idx] = fp
+        self.resident_bytes += fp.nbytes
+        while self.resident_bytes > self.budget and len(self.resident) > 1:
+            _, old = self.resident.popitem(last=False)
+            self.resident_bytes -= old.nbytes
+            self.evictions += 1
+
+    @property
+    def nbytes(self):
+        return self.resident_bytes + len(self.offsets) * 8
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 1.0,
+                "bytes_read": self.bytes_read, "evictions": self.evictions,
+                "resident_bytes": self.resident_bytes, "segment_bytes": self.offsets[-1]}
+
+    def report(self, stats):
+        """Print the read-back stats and count them into stats (instrument.Stats)"""
+        spilled = self.stats()
+        print(f"Spill store: hit rate {spilled['hit_rate']:.3f}, {spilled['bytes_read']} bytes read, {spilled['evictions']} evictions")
+        stats.count("spill_hits", spilled["hits"])
+        stats.count("spill_misses", spilled["misses"])
+        stats.count("spill_bytes_read", spilled["bytes_read"])
+
+    def close(self):
+        """Close and delete the segment file"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            os.unlink(self.path)
+
+class SignatureArray:
+    """
+    Kept signatures as rows of one growable (n, width) uint64 array
+     - rows of a previous run (e.g. memory-mapped) are copied in once
+     - rows(ids) gathers candidates in one fancy-index
+    """
+    def __init__(self, width, rows=None, capacity=1024):
+        rows = np.zeros((0, width), dtype=np.uint64) if rows is None else np.asarray(rows, dtype=np.uint64)
+        self.data = np.empty((max(capacity, len(rows)), width), dtype=np.uint64)
+        self.data[:len(rows)] = rows
+        self.size = len(rows)
+
+    def __len__(self):
+        return self.size
+
+    def append(self, signature):
+        if self.size == len(self.data):
+            data = np.empty((2 * len(self.data), self.data.shape[1]), dtype=np.uint64)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size] = signature
+        self.size += 1
+
+    def rows(self, ids):
+        return self.data[ids]
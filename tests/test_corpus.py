@@ -0,0 +1,35 @@
+import random
+
+import pytest
+
+from methods.corpus import list_docs, write_shards
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+def _records(count):
+    return [{"id": f"d{i}", "text": f"doc {i} " * (1 + i % 50), "length": len(f"doc {i} " * (1 + i % 50))}
+            for i in range(count)]
+
+def test_parquet_shards_read_by_position(tmp_path):
+    records = _records(5000)
+    write_shards(records, tmp_path, "part", shard_size=1200, fmt="parquet")
+    docs = list_docs(tmp_path)
+    assert len(docs) == len(records)
+    assert [doc.size for doc in docs] == sorted((rec["length"] for rec in records), reverse=True)
+    texts = {rec["id"]: rec["text"] for rec in records}
+    random.Random(0).shuffle(docs)
+    for doc in docs:
+        assert doc.read_text() == texts[doc.name]
+
+def test_parquet_without_id_and_length(tmp_path):
+    texts = [rec["text"] for rec in _records(300)]
+    pq.write_table(pa.Table.from_pylist([{"text": text} for text in texts]), tmp_path / "one.parquet")
+    docs = list_docs(tmp_path / "one.parquet")
+    assert max(doc.size for doc in docs) == docs[0].size
+    for doc in docs:
+        assert doc.read_text() == texts[int(doc.name.rsplit("-", 1)[1])]
+
+def test_parquet_length_truncates(tmp_path):
+    write_shards(_records(100), tmp_path, "part", shard_size=30, fmt="parquet")
+    assert len(list_docs(tmp_path, length=10)) == 10
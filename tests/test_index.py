@@ -0,0 +1,26 @@
+import contextlib
+import io
+
+from methods.index import Index
+from methods.lsh import dedup_lsh
+from methods.simhash import dedup_sim
+
+def _corpus(path, count):
+    path.mkdir()
+    for i in range(count):
+        (path / f"doc{i}.txt").write_text(f"document number {i} " + "shared words here " * (i % 3) + "x" * i)
+    return path
+
+def _run(fn, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+def test_append_to_empty_index(tmp_path):
+    empty, docs, index = _corpus(tmp_path / "empty", 0), _corpus(tmp_path / "docs", 20), tmp_path / "index"
+    for fn, params in ((dedup_lsh, {}), (dedup_sim, dict(t=7))):
+        _run(fn, empty, tmp_path / "out", n=4, k=64, r=4, index=index / fn.__name__, **params)
+        saved = Index.load(index / fn.__name__)
+        assert len(saved) == 0 and saved.loaded["signatures"].shape == (0, 64)
+        assert saved.loaded["band_keys"].shape == (0, 16)
+        result = _run(fn, docs, tmp_path / "out", n=4, k=64, r=4, index=index / fn.__name__, append=True, **params)
+        assert len(Index.load(index / fn.__name__)) == result["unique_count"] > 0
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from methods.lsh import LSH, ArrayLSH, BatchProbe
+
+@pytest.mark.parametrize("cls", [LSH, ArrayLSH])
+def test_batch_probe_matches_per_doc(cls):
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 1 << 63, size=(300, 64), dtype=np.uint64)
+    sigs = base[rng.integers(0, len(base), 1000)]
+    sigs[::3, :32] = base[0, :32] # a shared band prefix across batches
+    keep = rng.random(len(sigs)) < 0.6
+
+    single, expected = cls(64, 4), []
+    for i, sig in enumerate(sigs):
+        keys = single.band_keys(sig)
+        expected.append(single.query_keys(keys))
+        if keep[i]:
+            single.add_keys(i, keys)
+
+    batched, found = cls(64, 4), []
+    for start in range(0, len(sigs), 128):
+        probe = BatchProbe(batched, sigs[start:start + 128])
+        for i in range(len(probe.keys)):
+            found.append(probe.query(i))
+            if keep[start + i]:
+                probe.add(start + i, i)
+        probe.flush()
+    assert found == expected
@@ -0,0 +1,24 @@
+import pytest
+
+import methods.service
+from methods.service import DedupService
+
+DOCS = [(f"d{i}", f"shared text for the service test {i % 4} " * 20 + f"tail {i}") for i in range(12)]
+
+def _fail(a, b):
+    raise RuntimeError("verify failed")
+
+@pytest.mark.parametrize("t", [None, 7])
+def test_failed_batch_inserts_nothing(monkeypatch, t):
+    service, clean = DedupService(tau=0.5, k=64, r=4, t=t), DedupService(tau=0.5, k=64, r=4, t=t)
+    service.check(DOCS[:2], insert=True)
+    clean.check(DOCS[:2], insert=True)
+    with monkeypatch.context() as patch:
+        patch.setattr(methods.service, "hashed_jaccard", _fail)
+        with pytest.raises(RuntimeError):
+            service.check(DOCS[2:], insert=True)
+    assert len(service) == len(service.kept_signatures) == len(service.store.shingles) == len(clean)
+    assert service.check(DOCS[2:], insert=True) == clean.check(DOCS[2:], insert=True)
+    keys = service.lsh.band_keys_many(service.kept_signatures.data[:len(service)])
+    assert [sorted(ids.tolist()) for ids in service.lsh.query_many(keys)] == \
+        [sorted(ids.tolist()) for ids in clean.lsh.query_many(keys)]
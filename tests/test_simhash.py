@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+from methods.simhash import SimHashIndex, popcount64
+
+@pytest.mark.parametrize("t", [0, 3, 7, 16])
+def test_index_matches_brute_force(t):
+    rng = np.random.default_rng(t)
+    codes = rng.integers(0, 1 << 63, size=1500, dtype=np.uint64) << np.uint64(1)
+    for i in rng.choice(np.arange(1, len(codes)), 500, replace=False).tolist(): # near copies
+        codes[i] = codes[rng.integers(0, i)]
+        for bit in rng.choice(64, rng.integers(0, t + 3), replace=False).tolist():
+            codes[i] ^= np.uint64(1) << np.uint64(bit)
+    index = SimHashIndex(t=t, buffer=16, brute_max=64)
+    for i, code in enumerate(codes.tolist()):
+        assert index.candidates(code) == set(np.flatnonzero(popcount64(codes[:i] ^ np.uint64(code)) <= t).tolist())
+        index.add(i, code)
+    assert len(index) == len(codes) and (index.tables > 0) == (t < 16)